@@ -16,25 +16,65 @@ Generate the endpoint_map.yaml template from data in the endpoint_data.yaml
 file.
 
 By default the files in the same directory as this script are operated on, but
-different files can be optionally specified on the command line.
-
-The --check option verifies that the current output file is up-to-date with the
-latest data in the input file. The script exits with status code 2 if a
-mismatch is detected.
+different files can be optionally specified on the command line. When -i is
+given several times, the first file replaces endpoint_data.yaml and the next
+ones are overlays merged into it, in order: their mappings are merged
+recursively, their other values replace the existing ones and their null
+values remove the existing keys.
+
+The EndpointMap of the environments/ssl files which set it is generated from
+the same data, and written with the template unless -o is given without -e.
+The generated output of each service is kept in a cache, which is saved in
+the directory given with --cache-dir, so that only the services changed
+since, e.g. by an overlay, are generated again.
+
+The template is the default output format. With --format json or ansible,
+the endpoints are instead resolved with the values of the NetIpMap,
+ServiceNetMap, CloudEndpoints and, optionally, EndpointMap parameters given
+with --values, and written as a flat lookup table of the endpoint_map output,
+in JSON or as Ansible variables.
+
+The --check option verifies that the current output files, the template and
+the environments, are up-to-date with the latest data in the input file, by
+comparing their hash with the one of the generated files. The script exits
+with status code 2 if a mismatch is detected, after printing a diff of each
+endpoint of the template, or of each file, which differs.
 """
 import collections
-import copy
+import difflib
+import hashlib
 import itertools
+import json
 import os
 import sys
+import tempfile
 import yaml
 
+from six.moves.urllib import parse as urlparse
+
+# Use the tripleo_heat_templates package of the tree this tool belongs to
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '..', '..')))
+from tripleo_heat_templates import yaml_utils  # noqa: E402
 
-__all__ = ['load_endpoint_data', 'generate_endpoint_map_template',
-           'write_template', 'build_endpoint_map', 'check_up_to_date']
+
+__all__ = ['load_endpoint_data', 'merge_endpoint_data',
+           'generate_endpoint_map_template', 'environment_endpoint_map',
+           'generate_endpoint_table', 'load_parameter_values',
+           'render_template', 'generate_outputs', 'write_template',
+           'write_environments', 'write_json', 'write_ansible_vars',
+           'build_endpoint_map', 'check_differences', 'check_outputs',
+           'check_up_to_date', 'ServiceCache', 'BACKENDS',
+           'ENDPOINT_ENVIRONMENTS']
 
 (IN_FILE, OUT_FILE) = ('endpoint_data.yaml', 'endpoint_map.yaml')
 
+TREE_DIR = os.path.normpath(os.path.join(os.path.dirname(__file__), '..',
+                                         '..'))
+ENV_DIR = os.path.join(TREE_DIR, 'environments')
+# The sample environment generator configuration of the environments
+SAMPLE_ENV_CONFIG = os.path.join(TREE_DIR, 'sample-env-generator', 'ssl.yaml')
+
 SUBST = (SUBST_IP_ADDRESS, SUBST_CLOUDNAME) = ('IP_ADDRESS', 'CLOUDNAME')
 PARAMS = (PARAM_CLOUD_ENDPOINTS, PARAM_ENDPOINTMAP, PARAM_NETIPMAP,
           PARAM_SERVICENETMAP) = (
@@ -43,6 +83,28 @@ FIELDS = (F_PORT, F_PROTOCOL, F_HOST) = ('port', 'protocol', 'host')
 
 ENDPOINT_TYPES = frozenset(['Internal', 'Public', 'Admin'])
 
+# When the endpoints use TLS, or DNS names as host, in the environments
+SCOPES = (SCOPE_PUBLIC, SCOPE_EVERYWHERE, SCOPE_NEVER) = (
+    'public', 'everywhere', 'never')
+TLS_PROTOCOLS = {'http': 'https', 'ws': 'wss'}
+
+EnvironmentRules = collections.namedtuple('EnvironmentRules', ['tls', 'dns'])
+
+# The environments setting EndpointMap, and the scope of their endpoints
+# which use TLS and DNS names
+ENDPOINT_ENVIRONMENTS = collections.OrderedDict([
+    ('ssl/no-tls-endpoints-public-ip', EnvironmentRules(None, None)),
+    ('ssl/tls-endpoints-public-ip', EnvironmentRules(SCOPE_PUBLIC, None)),
+    ('ssl/tls-endpoints-public-dns', EnvironmentRules(SCOPE_PUBLIC,
+                                                      SCOPE_PUBLIC)),
+    ('ssl/tls-everywhere-endpoints-dns', EnvironmentRules(SCOPE_EVERYWHERE,
+                                                          SCOPE_EVERYWHERE)),
+])
+
+# The mappings of the template which are compared endpoint by endpoint
+ENDPOINT_PATHS = (('parameters', PARAM_ENDPOINTMAP, 'default'),
+                  ('outputs', 'endpoint_map', 'value'))
+
 
 def get_file(default_fn, override=None, writable=False):
     if override == '-':
@@ -59,9 +121,32 @@ def get_file(default_fn, override=None, writable=False):
     return open(filename, 'w' if writable else 'r')
 
 
-def load_endpoint_data(infile=None):
+def merge_endpoint_data(data, overlay):
+    """Merge an overlay into endpoint data
+
+    The mappings are merged recursively, the other values of the overlay
+    replace the ones of the data and its null values remove their key.
+    Neither data nor overlay are modified.
+    """
+    merged = dict(data)
+    for key, value in overlay.items():
+        if value is None:
+            merged.pop(key, None)
+        elif isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_endpoint_data(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def load_endpoint_data(infile=None, overlays=()):
+    """Load the endpoint data, merged with overlay files in order"""
     with get_file(IN_FILE, infile) as f:
-        return yaml.safe_load(f)
+        data = yaml_utils.safe_load(f)
+    for overlay in overlays:
+        with get_file(IN_FILE, overlay) as f:
+            data = merge_endpoint_data(data, yaml_utils.safe_load(f) or {})
+    return data
 
 
 def net_param_name(endpoint_type_defn):
@@ -84,6 +169,39 @@ def endpoint_map_default(config):
                                                          ENDPOINT_TYPES))
 
 
+def _in_scope(env_scope, endpoint_scope):
+    if endpoint_scope not in SCOPES:
+        raise Exception('Invalid endpoint scope %s' % endpoint_scope)
+    if env_scope == SCOPE_EVERYWHERE:
+        return endpoint_scope != SCOPE_NEVER
+    return env_scope is not None and endpoint_scope == env_scope
+
+
+def environment_endpoint_map(config, rules):
+    """Build the EndpointMap of an environment
+
+    The endpoints in the tls scope of the rules use the TLS variant of
+    their protocol, and their tls_port if they have one, and the endpoints
+    in the dns scope use CLOUDNAME as host.
+
+    :param rules: The EnvironmentRules of the environment
+    """
+    endpoint_map = endpoint_map_default(config)
+    for ep_name, svc in config.items():
+        for ep_type in set(svc) & ENDPOINT_TYPES:
+            defn = svc[ep_type]
+            default_scope = (SCOPE_PUBLIC if ep_type == 'Public'
+                             else SCOPE_EVERYWHERE)
+            values = endpoint_map[ep_name + ep_type]
+            if _in_scope(rules.tls, defn.get('tls', default_scope)):
+                values[F_PROTOCOL] = TLS_PROTOCOLS.get(values[F_PROTOCOL],
+                                                       values[F_PROTOCOL])
+                values[F_PORT] = str(defn.get('tls_port', values[F_PORT]))
+            if _in_scope(rules.dns, defn.get('dns', default_scope)):
+                values[F_HOST] = SUBST_CLOUDNAME
+    return endpoint_map
+
+
 def make_parameter(ptype, default, description=None):
     param = collections.OrderedDict([('type', ptype), ('default', default)])
     if description is not None:
@@ -111,64 +229,83 @@ def template_parameters(config):
     return params
 
 
-def template_output_definition(endpoint_name,
-                               endpoint_variant,
-                               endpoint_type,
-                               net_param,
-                               uri_suffix=None,
-                               name_override=None):
+def endpoint_fields(endpoint_name, endpoint_type, net_param):
+    """Build the outputs of an endpoint shared by all its variants
+
+    The sub-structures are shared between the outputs, and between the
+    variants of the endpoint, instead of being copied. They must not be
+    modified, TemplateDumper writes them in full each time.
+    """
     def extract_field(field):
         assert field in FIELDS
         return {'get_param': ['EndpointMap',
                               endpoint_name + endpoint_type,
-                              copy.copy(field)]}
+                              field]}
 
     port = extract_field(F_PORT)
     protocol = extract_field(F_PROTOCOL)
+    host_template = extract_field(F_HOST)
+    service_net = {'get_param': ['ServiceNetMap', net_param]}
+    cloudname = {'get_param': [PARAM_CLOUD_ENDPOINTS, service_net]}
     host_nobrackets = {
         'str_replace': collections.OrderedDict([
-            ('template', extract_field(F_HOST)),
+            ('template', host_template),
             ('params', {
-                SUBST_IP_ADDRESS: {'get_param':
-                                   ['NetIpMap',
-                                    {'get_param': ['ServiceNetMap',
-                                     net_param]}]},
-                SUBST_CLOUDNAME: {'get_param':
-                                  [PARAM_CLOUD_ENDPOINTS,
-                                   {'get_param': ['ServiceNetMap',
-                                     net_param]}]},
+                SUBST_IP_ADDRESS: {'get_param': ['NetIpMap', service_net]},
+                SUBST_CLOUDNAME: cloudname,
             })
         ])
     }
     host = {
         'str_replace': collections.OrderedDict([
-            ('template', extract_field(F_HOST)),
+            ('template', host_template),
             ('params', {
                 SUBST_IP_ADDRESS: {'get_param':
                                    ['NetIpMap',
                                     {'str_replace':
-                                    {'template': 'NETWORK_uri',
-                                     'params': {'NETWORK':
-                                     {'get_param': ['ServiceNetMap',
-                                                    net_param]}}}}]},
-                SUBST_CLOUDNAME: {'get_param':
-                                  [PARAM_CLOUD_ENDPOINTS,
-                                   {'get_param': ['ServiceNetMap',
-                                     net_param]}]},
+                                     {'template': 'NETWORK_uri',
+                                      'params': {'NETWORK': service_net}}}]},
+                SUBST_CLOUDNAME: cloudname,
             })
         ])
     }
     uri_no_path = {
         'make_url': collections.OrderedDict([
             ('scheme', protocol),
-            ('host', copy.deepcopy(host)),
+            ('host', host),
             ('port', port)
         ])
     }
-    uri_with_path = copy.deepcopy(uri_no_path)
+    return {
+        'host_nobrackets': host_nobrackets,
+        'host': host,
+        'port': port,
+        'protocol': protocol,
+        'uri_no_suffix': uri_no_path,
+    }
+
+
+def template_output_definition(endpoint_name,
+                               endpoint_variant,
+                               endpoint_type,
+                               net_param,
+                               uri_suffix=None,
+                               name_override=None,
+                               fields=None):
+    """Build the name and the outputs of an endpoint variant
+
+    :param fields: The shared outputs of the endpoint, as returned by
+                   endpoint_fields(), built if not given
+    """
+    if fields is None:
+        fields = endpoint_fields(endpoint_name, endpoint_type, net_param)
+    uri_no_path = fields['uri_no_suffix']
+    uri_with_path = uri_no_path
     if uri_suffix is not None:
         path, pc, suffix = uri_suffix.partition('%')
-        uri_with_path['make_url']['path'] = path
+        make_url = collections.OrderedDict(uri_no_path['make_url'])
+        make_url['path'] = path
+        uri_with_path = {'make_url': make_url}
         if pc:
             uri_with_path = {'list_join': ['', [uri_with_path, pc + suffix]]}
 
@@ -176,27 +313,24 @@ def template_output_definition(endpoint_name,
                                                             endpoint_variant +
                                                             endpoint_type)
 
-    return name, {
-        'host_nobrackets': host_nobrackets,
-        'host': host,
-        'port': extract_field('port'),
-        'protocol': extract_field('protocol'),
-        'uri': uri_with_path,
-        'uri_no_suffix': uri_no_path,
-    }
+    outputs = dict(fields)
+    outputs['uri'] = uri_with_path
+    return name, outputs
 
 
 def template_endpoint_items(config):
     def get_svc_endpoints(ep_name, svc):
         for ep_type in set(svc) & ENDPOINT_TYPES:
             defn = svc[ep_type]
+            fields = endpoint_fields(ep_name, ep_type, net_param_name(defn))
             for variant, suffix in defn.get('uri_suffixes',
                                             {'': None}).items():
                 name_override = defn.get('names', {}).get(variant)
                 yield template_output_definition(ep_name, variant, ep_type,
                                                  net_param_name(defn),
                                                  suffix,
-                                                 name_override)
+                                                 name_override,
+                                                 fields)
     return itertools.chain.from_iterable(sorted(get_svc_endpoints(ep_name,
                                                                   svc))
                                          for (ep_name,
@@ -227,10 +361,15 @@ autogen_warning = """### DO NOT MODIFY THIS FILE
 """
 
 
-class TemplateDumper(yaml.SafeDumper):
+class TemplateDumper(yaml_utils.SafeDumper):
     def represent_ordered_dict(self, data):
         return self.represent_dict(data.items())
 
+    def ignore_aliases(self, data):
+        # The generated template shares sub-structures, which are written
+        # in full instead of as anchors and aliases
+        return True
+
 
 TemplateDumper.add_representer(collections.OrderedDict,
                                TemplateDumper.represent_ordered_dict)
@@ -242,43 +381,482 @@ def write_template(template, filename=None):
         yaml.dump(template, f, TemplateDumper, width=68)
 
 
-def read_template(template, filename=None):
+class ServiceCache(object):
+    """The generated output of each service, keyed by the data it uses
+
+    The output of a service is only generated when it is not in the cache,
+    e.g. when an overlay changed the data of the service. With a cache_dir,
+    the cache is kept between runs in cache_dir/endpoint_map.json.
+    """
+
+    def __init__(self, cache_dir=None):
+        self.path = None
+        self.entries = {}
+        with open(__file__, 'rb') as f:
+            self.version = '%s-%s' % (hashlib.sha1(f.read()).hexdigest(),
+                                      yaml.__version__)
+        if cache_dir is not None:
+            self.path = os.path.join(cache_dir, 'endpoint_map.json')
+            try:
+                with open(self.path) as f:
+                    cache = json.load(f)
+                if cache.get('version') == self.version:
+                    self.entries = cache['entries']
+            except (IOError, OSError, ValueError):
+                pass
+        self.used = set()
+        self.generated = set()
+
+    def get(self, kind, ep_name, svc, generate):
+        """Get the output of a service, generated by generate()"""
+        key = hashlib.sha1(json.dumps([kind, ep_name, svc],
+                                      sort_keys=True).encode('utf-8'))
+        key = key.hexdigest()
+        if key not in self.entries:
+            self.entries[key] = generate()
+            self.generated.add(ep_name)
+        self.used.add(key)
+        return self.entries[key]
+
+    def save(self):
+        """Save the entries used since the cache was loaded"""
+        if self.path is None:
+            return
+        entries = dict((key, self.entries[key]) for key in self.used)
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            with tempfile.NamedTemporaryFile(
+                    'w', dir=os.path.dirname(self.path), delete=False) as f:
+                json.dump({'version': self.version, 'entries': entries}, f,
+                          sort_keys=True)
+            os.rename(f.name, self.path)
+        except (IOError, OSError) as e:
+            print('Warning: could not update the cache: %s' % e,
+                  file=sys.stderr)
+
+
+def _dump_at(path, data):
+    # Dump data as nested under the keys of path, without the keys, so that
+    # it is indented and wrapped as in the template
+    for key in reversed(path):
+        data = {key: data}
+    lines = yaml.dump(data, Dumper=TemplateDumper, width=68).splitlines(True)
+    return ''.join(lines[len(path):])
+
+
+def render_template(config, cache=None):
+    """Generate the text of the endpoint map template
+
+    The EndpointMap defaults and the outputs of each service are dumped
+    separately, through the cache, and then joined in the template.
+    """
+    if cache is None:
+        cache = ServiceCache()
+    service_parts = (
+        ('default', lambda ep_name, svc: endpoint_map_default(
+            {ep_name: svc})),
+        ('outputs', lambda ep_name, svc: collections.OrderedDict(
+            template_endpoint_items({ep_name: svc}))),
+    )
+    template = generate_endpoint_map_template({})
+    placeholders = {}
+    for path, (kind, generate) in zip(ENDPOINT_PATHS, service_parts):
+        parts = [cache.get(kind, ep_name, svc,
+                           lambda: _dump_at(path, generate(ep_name, svc)))
+                 for ep_name, svc in sorted(config.items())]
+        placeholder = 'ENDPOINTS_PLACEHOLDER_%s' % kind
+        placeholders[': %s\n' % placeholder] = (
+            ':\n' + ''.join(parts) if any(parts) else ': {}\n')
+        parent = template
+        for key in path[:-1]:
+            parent = parent[key]
+        parent[path[-1]] = placeholder
+    text = yaml.dump(template, Dumper=TemplateDumper, width=68)
+    for placeholder, parts in placeholders.items():
+        text = text.replace(placeholder, parts)
+    return text
+
+
+def _replace_block(text, header, indent, lines, start=0):
+    # Replace the lines starting with indent which follow the first header
+    # line found after start, and the blank lines after the header
+    try:
+        begin = text.index('\n%s\n' % header, start) + len(header) + 2
+    except ValueError:
+        raise Exception('Could not find %s' % header.strip())
+    while text.startswith('\n', begin):
+        begin += 1
+    end = begin
+    while text.startswith(indent, end):
+        end = text.find('\n', end) + 1 or len(text)
+    return (text[:begin] + ''.join(indent + line + '\n' for line in lines) +
+            text[end:])
+
+
+def environment_lines(config, rules, cache=None):
+    """Generate the lines of the EndpointMap of an environment"""
+    if cache is None:
+        cache = ServiceCache()
+
+    def generate(ep_name, svc):
+        return ["%s: {protocol: '%s', port: '%s', host: '%s'}" % (
+            name, values[F_PROTOCOL], values[F_PORT], values[F_HOST])
+            for name, values in environment_endpoint_map(
+                {ep_name: svc}, rules).items()]
+
+    return [line for ep_name, svc in sorted(config.items())
+            for line in cache.get(['environment', rules], ep_name, svc,
+                                  lambda: generate(ep_name, svc))]
+
+
+def environment_outputs(config, cache=None, env_dir=None):
+    """Generate the text of the files setting EndpointMap
+
+    These are the ENDPOINT_ENVIRONMENTS, whose EndpointMap is replaced, and
+    the sample environment generator configuration, whose sample values of
+    EndpointMap are replaced so that it generates the same files. With
+    env_dir, only the environments are generated, to be written to env_dir.
+
+    :returns: An OrderedDict mapping the paths of the files to their text
+    """
+    outputs = collections.OrderedDict()
+    if env_dir is None:
+        with open(SAMPLE_ENV_CONFIG) as f:
+            sample_config = f.read()
+    for name, rules in ENDPOINT_ENVIRONMENTS.items():
+        lines = environment_lines(config, rules, cache)
+        with open(os.path.join(ENV_DIR, name + '.yaml')) as f:
+            env = _replace_block(f.read(), '  EndpointMap:', ' ' * 4, lines)
+        outputs[os.path.join(env_dir or ENV_DIR, name + '.yaml')] = env
+        if env_dir is None:
+            sample_config = _replace_block(
+                sample_config, '      EndpointMap: |-2', ' ' * 12, lines,
+                sample_config.index('\n    name: %s\n' % name))
+    if env_dir is None:
+        outputs[SAMPLE_ENV_CONFIG] = sample_config
+    return outputs
+
+
+def generate_outputs(config, output_filename=None, cache=None, env_dir=None):
+    """Generate the text of the files written by the heat backend
+
+    These are the template and, unless output_filename is given without
+    env_dir, the environments, see environment_outputs().
+
+    :returns: An OrderedDict mapping the paths of the files to their text,
+              the template first
+    """
+    if cache is None:
+        cache = ServiceCache()
+    outputs = collections.OrderedDict()
+    template_filename = output_filename or os.path.join(
+        os.path.dirname(__file__), OUT_FILE)
+    outputs[template_filename] = autogen_warning + render_template(config,
+                                                                   cache)
+    if output_filename is None or env_dir is not None:
+        outputs.update(environment_outputs(config, cache, env_dir))
+    return outputs
+
+
+def write_outputs(outputs):
+    for filename, text in outputs.items():
+        if filename != '-' and not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with get_file(OUT_FILE, filename, writable=True) as f:
+            f.write(text)
+
+
+def write_environments(config, cache=None, env_dir=None):
+    """Write the files setting EndpointMap, see environment_outputs()"""
+    write_outputs(environment_outputs(config, cache, env_dir))
+
+
+def read_template(filename=None):
     with get_file(OUT_FILE, filename) as f:
-        return yaml.safe_load(f)
-
-
-def build_endpoint_map(output_filename=None, input_filename=None):
-    if output_filename is not None and output_filename == input_filename:
-        raise Exception('Cannot read from and write to the same file')
-    config = load_endpoint_data(input_filename)
+        return yaml_utils.safe_load(f)
+
+
+def load_parameter_values(filenames):
+    """Load the parameter values used to resolve the endpoints
+
+    The files are YAML or JSON mappings of the parameters to their values,
+    or Heat environment files whose parameter_defaults are used. The values
+    of the later files override the ones of the earlier files.
+    """
+    values = {}
+    for filename in filenames:
+        with open(filename) as f:
+            data = yaml_utils.safe_load(f) or {}
+        values.update(data.get('parameter_defaults', data))
+    return values
+
+
+def _str_replace(template, params):
+    # Like Heat, replace the longest keys first
+    for key in sorted(params, key=len, reverse=True):
+        template = template.replace(key, str(params[key]))
+    return template
+
+
+def _make_url(args):
+    host = args.get('host', '')
+    if ':' in host and not host.startswith('['):
+        host = '[%s]' % host
+    port = args.get('port', '')
+    netloc = host + (':%s' % port if port else '')
+    return urlparse.urlunsplit((args.get('scheme', ''), netloc,
+                                urlparse.quote(args.get('path', '')), '', ''))
+
+
+def _get_param(path, params):
+    value = params[path[0]]
+    for key in path[1:]:
+        # Heat resolves missing keys to an empty string
+        try:
+            value = value[key]
+        except (KeyError, IndexError, TypeError):
+            return ''
+    return value
+
+
+INTRINSIC_FUNCTIONS = {
+    'get_param': _get_param,
+    'str_replace': lambda args, params: _str_replace(args['template'],
+                                                     args['params']),
+    'make_url': lambda args, params: _make_url(args),
+    'list_join': lambda args, params: args[0].join(args[1]),
+}
+
+
+def resolve(value, params):
+    """Evaluate the intrinsic functions used by the endpoint map template"""
+    if isinstance(value, dict):
+        if len(value) == 1:
+            function, args = next(iter(value.items()))
+            if function in INTRINSIC_FUNCTIONS:
+                return INTRINSIC_FUNCTIONS[function](resolve(args, params),
+                                                     params)
+        return collections.OrderedDict((k, resolve(v, params))
+                                       for k, v in value.items())
+    if isinstance(value, list):
+        return [resolve(v, params) for v in value]
+    return value
+
+
+def generate_endpoint_table(config, values):
+    """Resolve the endpoint_map output of the template for given parameters
+
+    :param values: The values of the parameters of the template, which
+                   default to the ones of the template
+    :returns: An OrderedDict mapping the name of each endpoint to its
+              resolved host, host_nobrackets, port, protocol, uri and
+              uri_no_suffix
+    """
     template = generate_endpoint_map_template(config)
-    write_template(template, output_filename)
-
-
-def check_up_to_date(output_filename=None, input_filename=None):
+    params = dict((name, values.get(name, param['default']))
+                  for name, param in template['parameters'].items())
+    return collections.OrderedDict(
+        (name, collections.OrderedDict(
+            (field, resolve(value, params))
+            for field, value in sorted(outputs.items())))
+        for name, outputs in template['outputs']['endpoint_map'][
+            'value'].items())
+
+
+def write_json(table, filename=None):
+    with get_file(OUT_FILE, filename or '-', writable=True) as f:
+        json.dump(table, f, indent=2)
+        f.write('\n')
+
+
+def write_ansible_vars(table, filename=None):
+    with get_file(OUT_FILE, filename or '-', writable=True) as f:
+        yaml.dump({'endpoint_map': table}, f, TemplateDumper,
+                  default_flow_style=False)
+
+
+# The output formats: the function generating the output from the endpoint
+# data and the parameter values, and the function writing it
+BACKENDS = collections.OrderedDict([
+    ('heat', (lambda config, values: generate_endpoint_map_template(config),
+              write_template)),
+    ('json', (generate_endpoint_table, write_json)),
+    ('ansible', (generate_endpoint_table, write_ansible_vars)),
+])
+
+
+def build_endpoint_map(output_filename=None, input_filename=None,
+                       backend='heat', values_filenames=(),
+                       overlay_filenames=(), cache=None, env_dir=None):
+    """Write the endpoint map in the format of one of the BACKENDS
+
+    Only the heat backend writes to endpoint_map.yaml by default, the
+    others write to stdout. The heat backend also writes the environments,
+    see generate_outputs().
+
+    :param cache: The ServiceCache used to generate the template and the
+                  environments
+    """
+    if output_filename is not None and output_filename in (
+            (input_filename,) + tuple(overlay_filenames)):
+        raise Exception('Cannot read from and write to the same file')
+    config = load_endpoint_data(input_filename, overlay_filenames)
+    if backend != 'heat':
+        generate, write = BACKENDS[backend]
+        write(generate(config, load_parameter_values(values_filenames)),
+              output_filename)
+        return
+    write_outputs(generate_outputs(config, output_filename, cache, env_dir))
+
+
+def _plain(value):
+    if isinstance(value, dict):
+        return dict((k, _plain(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [_plain(v) for v in value]
+    return value
+
+
+def _dump_lines(value):
+    if value is None:
+        return []
+    return yaml_utils.safe_dump(_plain(value),
+                                default_flow_style=False).splitlines()
+
+
+def diff_templates(existing, template, labels=('existing', 'generated'),
+                   path=()):
+    """Generate the differences between two endpoint map templates
+
+    The endpoints of the EndpointMap parameter and of the endpoint_map
+    output are compared one by one, as well as the other parameters and
+    outputs, and the lines of a unified diff of the YAML of each of them
+    which differs are generated as they are found.
+
+    :param labels: The names of the existing and generated templates
+    """
+    if existing == template:
+        return
+    expand = not path or any(endpoint_path[:len(path)] == path
+                             for endpoint_path in ENDPOINT_PATHS)
+    if expand and isinstance(existing, dict) and isinstance(template, dict):
+        keys = list(template) + [k for k in existing if k not in template]
+        for key in keys:
+            for line in diff_templates(existing.get(key), template.get(key),
+                                       labels, path + (key,)):
+                yield line
+        return
+    name = '.'.join(str(key) for key in path)
+    for line in difflib.unified_diff(_dump_lines(existing),
+                                     _dump_lines(template),
+                                     '%s: %s' % (labels[0], name),
+                                     '%s: %s' % (labels[1], name),
+                                     lineterm=''):
+        yield line
+
+
+def check_differences(output_filename=None, input_filename=None,
+                      overlay_filenames=()):
+    """Generate the differences between the output file and the data
+
+    See diff_templates().
+    """
     if output_filename is not None and output_filename == input_filename:
         raise Exception('Input and output filenames must be different')
-    config = load_endpoint_data(input_filename)
+    config = load_endpoint_data(input_filename, overlay_filenames)
     template = generate_endpoint_map_template(config)
     existing_template = read_template(output_filename)
-    return existing_template == template
+    return diff_templates(existing_template, template,
+                          (output_filename or OUT_FILE,
+                           input_filename or IN_FILE))
+
+
+def check_outputs(output_filename=None, input_filename=None,
+                  overlay_filenames=(), env_dir=None, cache=None):
+    """Generate the differences between the output files and the data
+
+    The hash of each file written by build_endpoint_map() is compared with
+    the one of its generated text, and the lines of a diff of the files
+    which differ are generated: of their endpoints for the template, see
+    diff_templates(), of their text otherwise.
+    """
+    if output_filename is not None and output_filename in (
+            (input_filename,) + tuple(overlay_filenames)):
+        raise Exception('Input and output filenames must be different')
+    config = load_endpoint_data(input_filename, overlay_filenames)
+    outputs = generate_outputs(config, output_filename, cache, env_dir)
+    for i, (filename, text) in enumerate(outputs.items()):
+        try:
+            with open(filename, 'rb') as f:
+                existing = f.read()
+        except (IOError, OSError):
+            existing = b''
+        if (hashlib.sha1(existing).digest() ==
+                hashlib.sha1(text.encode('utf-8')).digest()):
+            continue
+        existing = existing.decode('utf-8')
+        found = False
+        if i == 0 and existing:
+            # The template, compared endpoint by endpoint
+            for line in diff_templates(yaml_utils.safe_load(existing),
+                                       generate_endpoint_map_template(config),
+                                       (filename, input_filename or IN_FILE)):
+                found = True
+                yield line
+        if not found:
+            for line in difflib.unified_diff(
+                    existing.splitlines(), text.splitlines(),
+                    filename, 'generated: %s' % filename, lineterm=''):
+                yield line
+
+
+def check_up_to_date(output_filename=None, input_filename=None,
+                     overlay_filenames=(), env_dir=None):
+    for _ in check_outputs(output_filename, input_filename,
+                           overlay_filenames, env_dir):
+        return False
+    return True
 
 
 def get_options():
     import argparse
 
     parser = argparse.ArgumentParser(
-        usage="%(prog)s [-i INPUT_FILE] [-o OUTPUT_FILE] [--check]",
+        usage="%(prog)s [-i INPUT_FILE [-i OVERLAY_FILE ...]] "
+              "[-o OUTPUT_FILE] [-e ENV_DIR] [--check] [-f FORMAT] "
+              "[--values VALUES_FILE] [--cache-dir CACHE_DIR]",
         description=__doc__)
-    parser.add_argument('-i', '--input', dest='input_file', action='store',
-                        default=None,
-                        help='Specify a different endpoint data file')
+    parser.add_argument('-i', '--input', dest='input_files', action='append',
+                        default=[],
+                        help='Specify a different endpoint data file, then '
+                             'overlay files merged into it in order')
     parser.add_argument('-o', '--output', dest='output_file', action='store',
                         default=None,
                         help='Specify a different endpoint map template file')
+    parser.add_argument('-e', '--environments-dir', dest='env_dir',
+                        action='store', default=None,
+                        help='Write the environments setting EndpointMap to '
+                             'a different directory')
+    parser.add_argument('--cache-dir', dest='cache_dir', action='store',
+                        default=None,
+                        help='Keep the generated output of each service in '
+                             'a cache in this directory')
+    parser.add_argument('-v', '--verbose', dest='verbose',
+                        action='store_true', default=False,
+                        help='Print the services whose output was generated '
+                             'instead of found in the cache')
     parser.add_argument('-c', '--check', dest='check', action='store_true',
                         default=False, help='Check that the output file is '
                                             'up to date with the data')
+    parser.add_argument('-f', '--format', dest='format',
+                        choices=list(BACKENDS), default='heat',
+                        help='Output format (default: %(default)s)')
+    parser.add_argument('--values', dest='values_files', action='append',
+                        default=[],
+                        help='Parameter values, or environment file, used '
+                             'to resolve the endpoints of the lookup table '
+                             'formats. Can be given several times.')
     parser.add_argument('-d', '--debug', dest='debug', action='store_true',
                         default=False, help='Print stack traces on error')
 
@@ -287,16 +865,34 @@ def get_options():
 
 def main():
     args = get_options()
+    input_file = args.input_files[0] if args.input_files else None
+    overlay_files = args.input_files[1:]
 
     try:
+        if args.check and args.format != 'heat':
+            raise Exception('--check only supports the heat format')
         if args.check:
-            if not check_up_to_date(args.output_file, args.input_file):
-                print('EndpointMap template does not match input data. Please '
-                      'run the build_endpoint_map.py tool to update the '
-                      'template.', file=sys.stderr)
+            up_to_date = True
+            for line in check_outputs(args.output_file, input_file,
+                                      overlay_files, args.env_dir,
+                                      ServiceCache(args.cache_dir)):
+                up_to_date = False
+                print(line)
+            if not up_to_date:
+                print('EndpointMap template or environments do not match '
+                      'input data. Please run the build_endpoint_map.py tool '
+                      'to update them.', file=sys.stderr)
                 sys.exit(2)
         else:
-            build_endpoint_map(args.output_file, args.input_file)
+            cache = ServiceCache(args.cache_dir)
+            build_endpoint_map(args.output_file, input_file, args.format,
+                               args.values_files, overlay_files, cache,
+                               args.env_dir)
+            cache.save()
+            if args.verbose:
+                print('Generated %d services: %s' % (
+                    len(cache.generated), ', '.join(sorted(cache.generated))),
+                    file=sys.stderr)
     except Exception as exc:
         if args.debug:
             raise
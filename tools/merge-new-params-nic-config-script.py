@@ -24,6 +24,10 @@ import yaml
 
 from tempfile import mkdtemp
 
+# Use the tripleo_heat_templates package of the tree this tool belongs to
+sys.path.insert(0, os.path.abspath(os.path.dirname(os.path.dirname(__file__))))
+from tripleo_heat_templates import yaml_utils  # noqa: E402
+
 DEFAULT_THT_DIR = '/usr/share/openstack-tripleo-heat-templates'
 NIC_CONFIG_REFERENCE = 'single-nic-vlans'
 
@@ -156,15 +160,6 @@ class TemplateDumper(yaml.SafeDumper):
         return self.represent_scalar('tag:yaml.org,2002:str', data, style='>')
 
 
-# FIXME: This duplicates code from tools/yaml-nic-config-2-script.py, we should
-# refactor to share the common code
-# We load mappings into OrderedDict to preserve their order
-class TemplateLoader(yaml.SafeLoader):
-    def construct_mapping(self, node):
-        self.flatten_mapping(node)
-        return collections.OrderedDict(self.construct_pairs(node))
-
-
 TemplateDumper.add_representer(six.text_type,
                                TemplateDumper.description_presenter)
 TemplateDumper.add_representer(six.binary_type,
@@ -172,8 +167,6 @@ TemplateDumper.add_representer(six.binary_type,
 
 TemplateDumper.add_representer(collections.OrderedDict,
                                TemplateDumper.represent_ordered_dict)
-TemplateLoader.add_constructor(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,
-                               TemplateLoader.construct_mapping)
 
 
 # FIXME: This duplicates code from tools/yaml-nic-config-2-script.py, we should
@@ -201,7 +194,7 @@ def process_templates_and_get_reference_parameters():
     # If deprecated_nic_config_names is set for role the deprecated name must
     # be used when loading the reference file.
     with open(OPTS.roles_data) as roles_data_file:
-        roles_data = yaml.safe_load(roles_data_file)
+        roles_data = yaml_utils.safe_load(roles_data_file)
     try:
         nic_config_name = next((x.get('deprecated_nic_config_name',
                                       OPTS.role_name.lower() + '.yaml')
@@ -216,7 +209,7 @@ def process_templates_and_get_reference_parameters():
     refernce_file = '/'.join([temp_dir, 'network/config', NIC_CONFIG_REFERENCE,
                               nic_config_name])
     with open(refernce_file) as reference:
-        reference_template = yaml.safe_load(reference)
+        reference_template = yaml_utils.safe_load(reference)
     reference_params = reference_template['parameters']
     shutil.rmtree(temp_dir)
 
@@ -243,7 +236,8 @@ def backup_template():
 
 def merge_from_processed(reference_params):
     with open(OPTS.template, 'r') as f:
-        template = yaml.load(f.read(), Loader=TemplateLoader)
+        # We load mappings into OrderedDict to preserve their order
+        template = yaml_utils.ordered_load(f.read())
 
     for param in reference_params:
         if param not in template['parameters']:
@@ -12,31 +12,101 @@
 # under the License.
 
 import argparse
+import filecmp
 import jinja2
+import jinja2.meta
+import json
+import multiprocessing
 import os
 import shutil
 import six
 import sys
-import yaml
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 __tht_root_dir = os.path.dirname(os.path.dirname(__file__))
 
+# Use the tripleo_heat_templates package of the tree this tool belongs to
+sys.path.insert(0, os.path.abspath(__tht_root_dir))
+from tripleo_heat_templates import render  # noqa: E402
+from tripleo_heat_templates import yaml_utils  # noqa: E402
 
-def _shutil_copy_if_not_same(src, dst):
-    """Copy with shutil ignoring the same file errors."""
-    if hasattr(shutil, 'SameFileError'):
-        try:
-            shutil.copy(src, dst)
-        except shutil.SameFileError:
-            pass
-    else:
+
+# Linux ioctl cloning a file into another one sharing the same extents, on
+# filesystems supporting copy-on-write (btrfs, xfs with reflink=1, ...)
+FICLONE = 0x40049409
+
+LINK_MODES = ('reflink', 'hardlink', 'copy')
+
+# The link modes are dropped from this set when they fail, so that the
+# following files are copied directly.
+_link_modes_available = set(['hardlink'])
+if fcntl is not None:
+    _link_modes_available.add('reflink')
+
+
+def _same_content(src, dst, src_stat):
+    """Check whether dst is a copy or a link of src.
+
+    Only a hard link is trusted from its metadata. The copies keep the
+    mtime of their source, so a different size or mtime means that dst is
+    out of date, and the content of the others is compared.
+    """
+    try:
+        dst_stat = os.stat(dst)
+    except OSError:
+        return False
+    if (src_stat.st_dev, src_stat.st_ino) == (dst_stat.st_dev,
+                                              dst_stat.st_ino):
+        return True
+    if (src_stat.st_size != dst_stat.st_size or
+            src_stat.st_mtime_ns != dst_stat.st_mtime_ns):
+        return False
+    return filecmp.cmp(src, dst, shallow=False)
+
+
+def _reflink(src, dst):
+    with open(src, 'rb') as src_f, open(dst, 'wb') as dst_f:
+        fcntl.ioctl(dst_f.fileno(), FICLONE, src_f.fileno())
+
+
+def _copy_static_file(src, dst, link_mode='copy'):
+    """Copy a file to the output dir, unless it is already there.
+
+    With the reflink and hardlink modes the file is cloned or hard linked
+    when the filesystem supports it, and copied otherwise. Links and clones
+    are created next to dst and renamed over it, so that dst is replaced
+    instead of being written through when it is already linked to another
+    file.
+
+    Returns one of 'unchanged', 'linked' or 'copied'.
+    """
+    src_stat = os.stat(src)
+    if _same_content(src, dst, src_stat):
+        return 'unchanged'
+
+    if link_mode in _link_modes_available:
+        tmp_dst = '%s.%d.tmp' % (dst, os.getpid())
         try:
-            shutil.copy(src, dst)
-        except Exception as ex:
-            if 'are the same file' in six.text_type(ex):
-                pass
+            if link_mode == 'hardlink':
+                os.link(src, tmp_dst)
             else:
-                raise
+                _reflink(src, tmp_dst)
+                shutil.copystat(src, tmp_dst)
+            os.rename(tmp_dst, dst)
+            return 'linked'
+        except (IOError, OSError):
+            # Not supported by the filesystem, or across filesystems
+            if os.path.exists(tmp_dst):
+                os.unlink(tmp_dst)
+            _link_modes_available.discard(link_mode)
+
+    shutil.copy2(src, dst)
+    return 'copied'
 
 
 def parse_opts(argv):
@@ -68,207 +138,442 @@ def parse_opts(argv):
                         action='store_true',
                         help=("""only output file names normally generated """
                               """from j2 templates"""))
+    parser.add_argument('--plan',
+                        action='store_true',
+                        help=("""only list the templates which would be """
+                              """rendered, with their estimated cost"""))
+    parser.add_argument('-j', '--jobs', metavar='JOBS', type=int,
+                        help=("""number of processes used to render the """
+                              """templates, 0 uses all available CPUs"""),
+                        default=1)
+    parser.add_argument('--cache-dir', metavar='CACHE_DIR',
+                        help=("""directory used to cache the compiled """
+                              """templates between runs, nothing is """
+                              """cached when it is not given"""))
+    parser.add_argument('--incremental',
+                        action='store_true',
+                        help=("""only render the templates whose inputs """
+                              """changed since the last run, as recorded """
+                              """in a manifest stored in --cache-dir"""))
+    parser.add_argument('-f', '--force',
+                        action='store_true',
+                        help=("""with --incremental, render every template """
+                              """and record it in the manifest"""))
+    parser.add_argument('--profile',
+                        action='store_true',
+                        help=("""report the render time and output size of """
+                              """each template and role/network, use """
+                              """--force with --incremental to profile """
+                              """every template"""))
+    parser.add_argument('--profile-output', metavar='PROFILE_OUTPUT',
+                        help=("""also write the profile to this JSON """
+                              """file"""))
+    parser.add_argument('--link-mode', choices=LINK_MODES,
+                        help=("""how the files which are not templates are """
+                              """put in the output dir, reflink and """
+                              """hardlink fall back to copying when not """
+                              """supported by the filesystem"""),
+                        default='reflink')
     opts = parser.parse_args(argv[1:])
+    if opts.incremental and not opts.cache_dir:
+        parser.error('--incremental requires --cache-dir')
 
     return opts
 
 
-def _j2_render_to_file(j2_template, j2_data, outfile_name=None,
-                       overwrite=True, dry_run=False):
-    yaml_f = outfile_name or j2_template.replace('.j2.yaml', '.yaml')
+class RenderManifest(object):
+    """Record of the inputs each output file was rendered from.
+
+    For every output the manifest stores the hash of the template source,
+    of the roles/networks data the template was rendered with, of every
+    *.j2 file it includes through the loader and of the rendered output.
+    An output is up to date when all of these still match.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.outputs = {}
+        self.references = {}
+        self._previous = {}
+        self._sources = {}
+        try:
+            with open(path) as manifest_file:
+                manifest = json.load(manifest_file)
+            if (manifest.get('version') == self.VERSION and
+                    manifest.get('jinja2') == jinja2.__version__):
+                self._previous = manifest['outputs']
+                self.references = manifest['references']
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    @staticmethod
+    def path_for(cache_dir, template_path, output_path):
+        """Get the manifest path used for a templates and output dir."""
+        key = render.source_hash('%s\0%s' % (
+            os.path.abspath(template_path), os.path.abspath(output_path)))
+        return os.path.join(cache_dir, 'manifest-%s.json' % key)
+
+    def _referenced_templates(self, env, j2_template):
+        source_hash = render.source_hash(j2_template)
+        if source_hash not in self.references:
+            try:
+                names = jinja2.meta.find_referenced_templates(
+                    env.parse(j2_template))
+                names = list(names)
+                # Dynamic includes can not be tracked
+                if None in names:
+                    names = None
+                else:
+                    names = sorted(set(names))
+            except jinja2.exceptions.TemplateSyntaxError:
+                names = None
+            self.references[source_hash] = names
+        return self.references[source_hash]
+
+    def _includes(self, search_path, j2_template):
+        """Get the hashes of all the files included by a template
+
+        Returns None when the included files can not be determined.
+        """
+        env = render.get_environment(search_path)
+        includes = {}
+        pending = [j2_template]
+        while pending:
+            names = self._referenced_templates(env, pending.pop())
+            if names is None:
+                return None
+            for name in names:
+                key = (search_path, name)
+                if key not in self._sources:
+                    try:
+                        source, filename, _ = env.loader.get_source(env,
+                                                                    name)
+                    except jinja2.exceptions.TemplateNotFound:
+                        return None
+                    self._sources[key] = (filename, source)
+                filename, source = self._sources[key]
+                if filename not in includes:
+                    includes[filename] = render.source_hash(source)
+                    pending.append(source)
+        return includes
+
+    def inputs(self, unit):
+        """Get the inputs of a render unit, as stored in the manifest."""
+        j2_data = json.dumps(unit.j2_data, sort_keys=True, default=str)
+        return {
+            'template': render.source_hash(unit.j2_template),
+            'data': render.source_hash(j2_data),
+            'includes': self._includes(unit.search_path, unit.j2_template),
+        }
+
+    def is_up_to_date(self, outfile_name, inputs):
+        previous = self._previous.get(os.path.abspath(outfile_name))
+        if previous is None or inputs['includes'] is None:
+            return False
+        if any(previous.get(k) != v for k, v in inputs.items()):
+            return False
+        try:
+            with open(outfile_name) as out_f:
+                return (render.source_hash(out_f.read()) ==
+                        previous.get('output'))
+        except (IOError, OSError):
+            return False
+
+    def update(self, outfile_name, inputs, output_hash=None):
+        """Record the inputs of an output file.
+
+        The output is recorded with the inputs it was last rendered from
+        when output_hash is None.
+        """
+        key = os.path.abspath(outfile_name)
+        if output_hash is None:
+            self.outputs[key] = self._previous[key]
+        else:
+            self.outputs[key] = dict(inputs, output=output_hash)
+
+    def save(self):
+        manifest = {'version': self.VERSION,
+                    'jinja2': jinja2.__version__,
+                    'outputs': self.outputs,
+                    'references': self.references}
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+
+class RenderProfile(object):
+    """Render times and output sizes, per template and per role/network."""
+
+    def __init__(self):
+        self.templates = {}
+        self.items = {}
+
+    @staticmethod
+    def _item_name(unit):
+        # The role or network the unit was rendered for
+        if 'role' in unit.j2_data:
+            role = unit.j2_data['role']
+            return 'role %s' % (role if isinstance(role, six.string_types)
+                                else role.get('name'))
+        if 'network' in unit.j2_data:
+            return 'network %s' % unit.j2_data['network'].get('name')
+        return 'all roles and networks'
+
+    def add(self, unit, seconds, size):
+        for stats, key in ((self.templates, unit.template_path),
+                           (self.items, self._item_name(unit))):
+            entry = stats.setdefault(key, {'time': 0.0, 'calls': 0,
+                                           'size': 0})
+            entry['time'] += seconds
+            entry['calls'] += 1
+            entry['size'] += size
+
+    @staticmethod
+    def _print_table(title, stats):
+        print(title)
+        print('%10s  %6s  %10s  %s' % ('TIME (s)', 'CALLS', 'SIZE (B)',
+                                       'NAME'))
+        for name, entry in sorted(stats.items(),
+                                  key=lambda i: (-i[1]['time'], i[0])):
+            print('%10.3f  %6d  %10d  %s' % (entry['time'], entry['calls'],
+                                             entry['size'], name))
+
+    def report(self):
+        self._print_table('j2 render profile by template:', self.templates)
+        self._print_table('j2 render profile by role/network:', self.items)
+        print('j2 render time: %.3fs' % sum(
+            entry['time'] for entry in self.templates.values()))
+
+    def write(self, path):
+        with open(path, 'w') as profile_file:
+            json.dump({'templates': self.templates, 'roles_networks':
+                       self.items}, profile_file, indent=2, sort_keys=True)
+
+
+def _write_if_changed(outfile_name, content, content_hash):
+    """Replace the content of a file, unless it is already up to date.
+
+    The new content is written to a temporary file which is then renamed
+    over the output, so the output is either the old or the new file and
+    its mtime only changes when its content does.
+
+    Returns True when the file was written.
+    """
+    try:
+        with open(outfile_name) as out_f:
+            if render.source_hash(out_f.read()) == content_hash:
+                return False
+    except (IOError, OSError):
+        pass
+
+    out_dir, out_name = os.path.split(outfile_name)
+    with tempfile.NamedTemporaryFile('w', dir=out_dir or '.',
+                                     prefix='.%s.' % out_name,
+                                     delete=False) as tmp_f:
+        tmp_f.write(content)
+    if os.path.exists(outfile_name):
+        shutil.copymode(outfile_name, tmp_f.name)
+    else:
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_f.name, 0o666 & ~umask)
+    os.rename(tmp_f.name, outfile_name)
+    return True
+
+
+def _j2_render_to_files(render_units, output_path, overwrite=True,
+                        dry_run=False, jobs=1, cache_dir=None, manifest=None,
+                        force=False, profile=None):
+    """Render all the units and write them to their output files.
+
+    The units are rendered in a pool of ``jobs`` worker processes when more
+    than one job is requested, but the outputs are always checked, written
+    and reported by the parent process in the order of ``render_units``, so
+    the result is the same as rendering them serially.
+
+    When a manifest is given, the units whose inputs did not change since
+    the previous run are not rendered again, unless force is set.
+
+    The render time and output size of each unit is recorded in profile
+    when given.
+
+    Returns the number of written, unchanged and skipped output files.
+    """
     if dry_run:
         amend = 'dry run processing'
     else:
         amend = 'rendering'
-    print('%s j2 template to file: %s' % (amend, outfile_name))
-
-    if not overwrite and os.path.exists(outfile_name):
-        print('ERROR: path already exists for file: %s' % outfile_name)
-        sys.exit(1)
 
-    # Search for templates relative to the current template path first
-    template_base = os.path.dirname(yaml_f)
-    j2_loader = \
-        jinja2.loaders.FileSystemLoader([template_base, __tht_root_dir])
+    written = unchanged = skipped = 0
+    render.init_cache(cache_dir)
+    render_inputs = []
+    stale_units = []
+    for unit in render_units:
+        outfile_name = os.path.join(output_path, unit.output_path)
+        inputs = None
+        up_to_date = False
+        if unit.excluded:
+            up_to_date = True
+        elif manifest is not None:
+            inputs = manifest.inputs(unit)
+            up_to_date = (not force and
+                          manifest.is_up_to_date(outfile_name, inputs))
+        render_inputs.append((outfile_name, inputs, up_to_date))
+        if not up_to_date:
+            stale_units.append(unit)
+
+    pool = None
+    if jobs > 1 and len(stale_units) > 1:
+        pool = multiprocessing.Pool(jobs, render.init_cache, (cache_dir,))
+        chunksize = max(1, len(stale_units) // (jobs * 4))
+        rendered = pool.imap(render.render_unit_timed, stale_units,
+                             chunksize)
+    else:
+        rendered = six.moves.map(render.render_unit_timed, stale_units)
 
     try:
-        # Render the j2 template
-        template = jinja2.Environment(loader=j2_loader).from_string(
-            j2_template)
-        r_template = template.render(**j2_data)
-    except jinja2.exceptions.TemplateError as ex:
-        error_msg = ("Error rendering template %s : %s"
-                     % (yaml_f, six.text_type(ex)))
-        print(error_msg)
-        raise Exception(error_msg)
-    if not dry_run:
-        with open(outfile_name, 'w') as out_f:
-            out_f.write(r_template)
+        for unit, (outfile_name, inputs, up_to_date) in zip(render_units,
+                                                           render_inputs):
+            if unit.excluded:
+                print('skipping rendering of %s' % outfile_name)
+                skipped += 1
+                continue
+
+            if not overwrite and os.path.exists(outfile_name):
+                print('%s j2 template to file: %s' % (amend, outfile_name))
+                print('ERROR: path already exists for file: %s'
+                      % outfile_name)
+                sys.exit(1)
+
+            if up_to_date:
+                print('skipping up to date j2 template file: %s'
+                      % outfile_name)
+                manifest.update(outfile_name, inputs)
+                skipped += 1
+                continue
+
+            print('%s j2 template to file: %s' % (amend, outfile_name))
+            try:
+                r_template, seconds = next(rendered)
+            except render.TemplateRenderError as ex:
+                print(six.text_type(ex))
+                raise
+            if profile is not None:
+                profile.add(unit, seconds, len(r_template))
+            if not dry_run:
+                r_hash = render.source_hash(r_template)
+                if _write_if_changed(outfile_name, r_template, r_hash):
+                    written += 1
+                else:
+                    unchanged += 1
+                if manifest is not None:
+                    manifest.update(outfile_name, inputs, r_hash)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if manifest is not None and not dry_run:
+            manifest.save()
+
+    return written, unchanged, skipped
+
+
+def _copy_to_output_dir(template_path, output_dir, link_mode='copy'):
+    """Copy all the files of a templates tree to the output dir.
+
+    The j2 templates are not copied, except for the *.j2 files which are
+    included by other templates. Files which are already up to date in the
+    output dir are left untouched.
+    """
+    results = {'unchanged': 0, 'linked': 0, 'copied': 0}
+    for subdir, dirs, files in os.walk(template_path):
+        # Skip hidden dirs and files, as for rendering
+        dirs[:] = [d for d in dirs if not d[0] == '.']
+        files = [f for f in files if not f[0] == '.']
+
+        # NOTE(flaper87): We could have used shutil.copytree
+        # but it requires the dst dir to not be present. This
+        # approach is safer as it doesn't require us to delete
+        # the output_dir in advance and it allows for running
+        # the command multiple times with the same output_dir.
+        out_dir = os.path.join(output_dir,
+                               os.path.relpath(subdir, template_path))
+        if not os.path.exists(out_dir):
+            os.mkdir(out_dir)
 
+        for f in files:
+            if not f.endswith('.j2.yaml'):
+                result = _copy_static_file(os.path.join(subdir, f),
+                                           os.path.join(out_dir, f),
+                                           link_mode)
+                results[result] += 1
 
-def process_templates(template_path, role_data_path, output_dir,
-                      network_data_path, overwrite, dry_run):
+    print('static files: %(copied)d copied, %(linked)d linked, '
+          '%(unchanged)d unchanged' % results)
 
-    with open(role_data_path) as role_data_file:
-        role_data = yaml.safe_load(role_data_file)
 
-    with open(network_data_path) as network_data_file:
-        network_data = yaml.safe_load(network_data_file)
-        if network_data is None:
-            network_data = []
+def process_templates(template_path, role_data_path, output_dir,
+                      network_data_path, overwrite, dry_run, jobs=1,
+                      cache_dir=None, incremental=False, force=False,
+                      link_mode='copy', profile=None):
 
-    j2_excludes = {}
-    j2_excludes_path = os.path.join(template_path, 'j2_excludes.yaml')
-    if os.path.exists(j2_excludes_path):
-        with open(j2_excludes_path) as role_data_file:
-            j2_excludes = yaml.safe_load(role_data_file)
+    role_data = render.load_roles_data(role_data_path)
+    network_data = render.load_network_data(network_data_path)
+    j2_excludes = render.load_j2_excludes(template_path)
 
     if output_dir and not os.path.isdir(output_dir):
         if os.path.exists(output_dir):
             raise RuntimeError('Output dir %s is not a directory' % output_dir)
         os.mkdir(output_dir)
 
-    role_names = [r.get('name') for r in role_data]
-    r_map = {}
-    for r in role_data:
-        r_map[r.get('name')] = r
-
-    n_map = {}
-    for n in network_data:
-        if (n.get('enabled') is not False):
-            n_map[n.get('name')] = n
-            if not n.get('name_lower'):
-                n_map[n.get('name')]['name_lower'] = n.get('name').lower()
-        else:
-            print("skipping %s network: network is disabled" % n.get('name'))
-
-    excl_templates = ['%s/%s' % (template_path, e)
-                      for e in j2_excludes.get('name', [])]
-
-    if os.path.isdir(template_path):
-        for subdir, dirs, files in os.walk(template_path):
-
-            # NOTE(flaper87): Ignore hidden dirs as we don't
-            # generate templates for those.
-            # Note the slice assignment for `dirs` is necessary
-            # because we need to modify the *elements* in the
-            # dirs list rather than the reference to the list.
-            # This way we'll make sure os.walk will iterate over
-            # the shrunk list. os.walk doesn't have an API for
-            # filtering dirs at this point.
-            dirs[:] = [d for d in dirs if not d[0] == '.']
-            files = [f for f in files if not f[0] == '.']
-
-            # NOTE(flaper87): We could have used shutil.copytree
-            # but it requires the dst dir to not be present. This
-            # approach is safer as it doesn't require us to delete
-            # the output_dir in advance and it allows for running
-            # the command multiple times with the same output_dir.
-            out_dir = subdir
-            if output_dir:
-                if template_path != '.':
-                    # strip out base path if not default
-                    temp = out_dir.split(template_path)[1]
-                    out_dir = temp[1:] if temp.startswith('/') else temp
-                out_dir = os.path.join(output_dir, out_dir)
-                if not os.path.exists(out_dir):
-                    os.mkdir(out_dir)
-
-            # Ensure template is on its expected search path
-            # for upcoming parsing and rendering
-            for f in files:
-                if f.endswith('.j2') and output_dir:
-                    _shutil_copy_if_not_same(os.path.join(subdir, f), out_dir)
-
-            for f in files:
-                file_path = os.path.join(subdir, f)
-                # We do three templating passes here:
-                # 1. *.role.j2.yaml - we template just the role name
-                #    and create multiple files (one per role)
-                # 2  *.network.j2.yaml - we template the network name and
-                #    data and create multiple files for networks and
-                #    network ports (one per network)
-                # 3. *.j2.yaml - we template with all roles_data,
-                #    and create one file common to all roles
-                if f.endswith('.role.j2.yaml'):
-                    print("jinja2 rendering role template %s" % f)
-                    with open(file_path) as j2_template:
-                        template_data = j2_template.read()
-                        print("jinja2 rendering roles %s" % ","
-                              .join(role_names))
-                        for role in role_names:
-                            j2_data = {'role': r_map[role]}
-                            out_f = "-".join(
-                                [role.lower(),
-                                 os.path.basename(f).replace('.role.j2.yaml',
-                                                             '.yaml')])
-                            out_f_path = os.path.join(out_dir, out_f)
-                            if ('network/config' in file_path and
-                                r_map[role].get('deprecated_nic_config_name')):
-                                d_name = r_map[role].get(
-                                    'deprecated_nic_config_name')
-                                out_f_path = os.path.join(out_dir, d_name)
-                            elif ('network/config' in file_path):
-                                d_name = "%s.yaml" % role.lower()
-                                out_f_path = os.path.join(out_dir, d_name)
-                            if not (out_f_path in excl_templates):
-                                if '{{role.name}}' in template_data:
-                                    j2_data = {'role': r_map[role],
-                                               'networks': network_data}
-                                    _j2_render_to_file(template_data, j2_data,
-                                                       out_f_path, overwrite,
-                                                       dry_run)
-                                else:
-                                    # Backwards compatibility with templates
-                                    # that specify {{role}} vs {{role.name}}
-                                    j2_data = {'role': role,
-                                               'networks': network_data}
-                                    _j2_render_to_file(
-                                        template_data, j2_data,
-                                        out_f_path, overwrite, dry_run)
-
-                            else:
-                                print('skipping rendering of %s' % out_f_path)
-
-                elif f.endswith('.network.j2.yaml'):
-                    print("jinja2 rendering network template %s" % f)
-                    with open(file_path) as j2_template:
-                        template_data = j2_template.read()
-                    print("jinja2 rendering networks %s" % ",".join(n_map))
-                    for network in n_map:
-                        j2_data = {'network': n_map[network]}
-                        # Output file names in "<name>.yaml" format
-                        out_f = os.path.basename(f).replace('.network.j2.yaml',
-                                                            '.yaml')
-                        if os.path.dirname(file_path).endswith('ports'):
-                            out_f = out_f.replace('port',
-                                                  n_map[network]['name_lower'])
-                        else:
-                            out_f = out_f.replace('network',
-                                                  n_map[network]['name_lower'])
-                        out_f_path = os.path.join(out_dir, out_f)
-                        if not (out_f_path in excl_templates):
-                            _j2_render_to_file(template_data, j2_data,
-                                               out_f_path, overwrite, dry_run)
-                        else:
-                            print('skipping rendering of %s' % out_f_path)
-
-                elif f.endswith('.j2.yaml'):
-                    print("jinja2 rendering normal template %s" % f)
-                    with open(file_path) as j2_template:
-                        template_data = j2_template.read()
-                        j2_data = {'roles': role_data,
-                                   'networks': network_data}
-                        out_f = os.path.basename(f).replace('.j2.yaml',
-                                                            '.yaml')
-                        out_f_path = os.path.join(out_dir, out_f)
-                        _j2_render_to_file(template_data, j2_data, out_f_path,
-                                           overwrite, dry_run)
-                elif output_dir:
-                    _shutil_copy_if_not_same(os.path.join(subdir, f), out_dir)
-
-    else:
+    if not os.path.isdir(template_path):
         print('Unexpected argument %s' % template_path)
+        return
+
+    if output_dir:
+        _copy_to_output_dir(template_path, output_dir, link_mode)
+
+    render_units = list(render.render_units(template_path, role_data,
+                                            network_data, j2_excludes,
+                                            __tht_root_dir, print))
+    manifest = None
+    if incremental:
+        manifest = RenderManifest(RenderManifest.path_for(
+            cache_dir, template_path, output_dir or template_path))
+    written, unchanged, skipped = _j2_render_to_files(
+        render_units, output_dir or template_path, overwrite, dry_run, jobs,
+        cache_dir, manifest, force, profile)
+    if not dry_run:
+        print('j2 templates: %d written, %d unchanged, %d skipped'
+              % (written, unchanged, skipped))
+
+
+def print_plan(template_path, role_data_path, network_data_path):
+    """Print all the render units of a tree with their estimated cost."""
+    role_data = render.load_roles_data(role_data_path)
+    network_data = render.load_network_data(network_data_path)
+    j2_excludes = render.load_j2_excludes(template_path)
+
+    plan = render.plan_templates(template_path, __tht_root_dir)
+    render_units = list(render.render_units(template_path, role_data,
+                                            network_data, j2_excludes,
+                                            plan=plan))
+    total_cost = 0
+    print('%10s  %-8s  %s' % ('COST', 'KIND', 'OUTPUT (TEMPLATE)'))
+    kinds = dict((t.template_path, t.kind) for t in plan)
+    for unit in render_units:
+        if unit.excluded:
+            cost = 'excluded'
+        else:
+            cost = render.estimated_cost(unit)
+            total_cost += cost
+        print('%10s  %-8s  %s (%s)' % (cost, kinds[unit.template_path],
+                                       unit.output_path, unit.template_path))
+    print('%d templates, %d render units, estimated total cost %d'
+          % (len(plan), len(render_units), total_cost))
 
 
 def clean_templates(base_path, role_data_path, network_data_path):
@@ -286,7 +591,7 @@ def clean_templates(base_path, role_data_path, network_data_path):
                 delete(rendered_path)
 
     with open(network_data_path) as network_data_file:
-        network_data = yaml.safe_load(network_data_file)
+        network_data = yaml_utils.safe_load(network_data_file)
 
     for network in network_data:
         network_path = os.path.join(
@@ -324,7 +629,7 @@ def clean_templates(base_path, role_data_path, network_data_path):
         delete(ports_from_pool_v6_path)
 
     with open(role_data_path) as role_data_file:
-        role_data = yaml.safe_load(role_data_file)
+        role_data = yaml_utils.safe_load(role_data_file)
 
     for role in role_data:
         role_path = os.path.join(
@@ -354,13 +659,33 @@ def clean_templates(base_path, role_data_path, network_data_path):
                         role['deprecated_nic_config_name']))
 
 
-opts = parse_opts(sys.argv)
+def main():
+    opts = parse_opts(sys.argv)
+
+    role_data_path = os.path.join(opts.base_path, opts.roles_data)
+    network_data_path = os.path.join(opts.base_path, opts.network_data)
 
-role_data_path = os.path.join(opts.base_path, opts.roles_data)
-network_data_path = os.path.join(opts.base_path, opts.network_data)
+    jobs = opts.jobs
+    if jobs < 1:
+        jobs = multiprocessing.cpu_count()
+    profile = None
+    if opts.profile or opts.profile_output:
+        profile = RenderProfile()
 
-if opts.clean:
-    clean_templates(opts.base_path, role_data_path, network_data_path)
-else:
-    process_templates(opts.base_path, role_data_path, opts.output_dir,
-                      network_data_path, (not opts.safe), opts.dry_run)
+    if opts.clean:
+        clean_templates(opts.base_path, role_data_path, network_data_path)
+    elif opts.plan:
+        print_plan(opts.base_path, role_data_path, network_data_path)
+    else:
+        process_templates(opts.base_path, role_data_path, opts.output_dir,
+                          network_data_path, (not opts.safe), opts.dry_run,
+                          jobs, opts.cache_dir, opts.incremental, opts.force,
+                          opts.link_mode, profile)
+        if profile is not None:
+            profile.report()
+            if opts.profile_output:
+                profile.write(opts.profile_output)
+
+
+if __name__ == '__main__':
+    main()
@@ -23,6 +23,10 @@ import sys
 import yaml
 import yaql
 
+# Use the tripleo_heat_templates package of the tree this tool belongs to
+sys.path.insert(0, os.path.abspath(os.path.dirname(os.path.dirname(__file__))))
+from tripleo_heat_templates import yaml_utils  # noqa: E402
+
 
 def parse_opts(argv):
     parser = argparse.ArgumentParser(
@@ -58,7 +62,7 @@ def main():
     output = opts.output
     # We open the resource registry once
     resource_registry = "./overcloud-resource-registry-puppet.yaml"
-    resource_reg = yaml.load(open(os.path.join(resource_registry), 'r'))
+    resource_reg = yaml_utils.safe_load(open(os.path.join(resource_registry), 'r'))
 
     if (opts.all):
         # This means we will parse all the services defined
@@ -73,7 +77,7 @@ def main():
             # The service definition will be the same resource registry
             role_resources = resource_reg
         else:
-            role_resources = yaml.load(open(os.path.join("./roles/", role + ".yaml"), 'r'))
+            role_resources = yaml_utils.safe_load(open(os.path.join("./roles/", role + ".yaml"), 'r'))
 
         for section_task in opts.ansible_tasks:
             if(opts.all):
@@ -102,7 +106,7 @@ def main():
                     if('::' in config_file):
                         print("This is a nested Heat resource")
                     else:
-                        data_source = yaml.load(open("./" + config_file, 'r'))
+                        data_source = yaml_utils.safe_load(open("./" + config_file, 'r'))
                         expression = engine(
                           "$.outputs.role_data.value.get(" + section_task + ").flatten().distinct()"
                         )
@@ -121,7 +125,11 @@ def main():
                         if exc.errno != errno.EEXIST:
                             raise
                 save = open(tasks_output_file, 'w+')
-                yaml.dump(yaml.load(json.dumps(role_ansible_tasks)), save, default_flow_style=False)
+                # The pure Python dumper keeps the formatting of the
+                # generated tasks, which libyaml's emitter may change
+                yaml.dump(yaml_utils.safe_load(json.dumps(role_ansible_tasks)),
+                          save, Dumper=yaml.SafeDumper,
+                          default_flow_style=False)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Compare yaml.safe_load with the shared loading helpers on a tree.
+
+Every .yaml file of the tree is parsed with both loaders, which must return
+the same documents, and the best time of a few rounds is reported.
+"""
+
+import argparse
+import os
+import sys
+import time
+import yaml
+
+# Use the tripleo_heat_templates package of the tree this tool belongs to
+sys.path.insert(0, os.path.abspath(os.path.dirname(os.path.dirname(__file__))))
+from tripleo_heat_templates import yaml_utils  # noqa: E402
+
+
+def parse_opts(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('path', nargs='?', default='.',
+                        help='tree of templates to parse')
+    parser.add_argument('-r', '--rounds', type=int, default=3,
+                        help='number of times each loader parses the tree')
+    return parser.parse_args(argv[1:])
+
+
+def read_templates(path):
+    contents = {}
+    for subdir, dirs, files in os.walk(path):
+        if '.tox' in dirs:
+            dirs.remove('.tox')
+        for f in files:
+            if f.endswith('.yaml') and not f.endswith('.j2.yaml'):
+                file_path = os.path.join(subdir, f)
+                with open(file_path) as template:
+                    contents[file_path] = template.read()
+    return contents
+
+
+def load_all(load, contents):
+    documents = {}
+    for file_path, content in contents.items():
+        try:
+            documents[file_path] = load(content)
+        except yaml.YAMLError as exc:
+            documents[file_path] = str(exc)
+    return documents
+
+
+def best_time(load, contents, rounds):
+    times = []
+    for _ in range(rounds):
+        start = time.time()
+        documents = load_all(load, contents)
+        times.append(time.time() - start)
+    return min(times), documents
+
+
+def main():
+    opts = parse_opts(sys.argv)
+    contents = read_templates(opts.path)
+    print('%d files, libyaml %savailable' % (
+        len(contents), '' if yaml_utils.libyaml_available else 'not '))
+
+    py_time, py_documents = best_time(yaml.safe_load, contents, opts.rounds)
+    print('yaml.safe_load: %.3fs' % py_time)
+    c_time, c_documents = best_time(yaml_utils.safe_load, contents,
+                                    opts.rounds)
+    print('yaml_utils.safe_load: %.3fs (%.1fx)' % (c_time,
+                                                   py_time / c_time))
+
+    different = sorted(f for f in contents
+                       if py_documents[f] != c_documents[f])
+    for file_path in different:
+        print('ERROR: %s is loaded differently' % file_path)
+    if different:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
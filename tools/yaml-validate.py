@@ -12,14 +12,35 @@
 # under the License.
 
 import argparse
+import collections
+import contextlib
+import ctypes
+import ctypes.util
+import fnmatch
+import functools
+import hashlib
+import json
+import multiprocessing
 import os
+import pickle
 import re
+import select
 import six
+import struct
+import subprocess
 import sys
+import tempfile
+import time
 import traceback
-import yaml
 
 from copy import copy
+from xml.sax.saxutils import escape
+from xml.sax.saxutils import quoteattr
+
+# Use the tripleo_heat_templates package of the tree this tool belongs to
+sys.path.insert(0, os.path.abspath(os.path.dirname(os.path.dirname(__file__))))
+from tripleo_heat_templates import render  # noqa: E402
+from tripleo_heat_templates import yaml_utils  # noqa: E402
 
 
 def is_string(value):
@@ -40,15 +61,10 @@ current_heat_template_version = valid_heat_template_versions[-1]
 required_params = ['EndpointMap', 'ServiceNetMap', 'DefaultPasswords',
                    'RoleName', 'RoleParameters', 'ServiceData']
 
-# NOTE(bnemec): The duplication in this list is intentional.  For the
-# transition to generated environments we have two copies of these files,
-# so they need to be listed twice.  Once the deprecated version can be removed
-# the duplicate entries can be as well.
-envs_containing_endpoint_map = ['no-tls-endpoints-public-ip.yaml',
-                                'tls-endpoints-public-dns.yaml',
-                                'tls-endpoints-public-ip.yaml',
-                                'tls-everywhere-endpoints-dns.yaml']
-ENDPOINT_MAP_FILE = 'endpoint_map.yaml'
+# NOTE: The EndpointMap of endpoint_map.yaml and of the environments/ssl
+# files is not checked here, they are generated and compared with their
+# sources by network/endpoints/build_endpoint_map.py --check, which runs
+# before this script in the tox pep8 env.
 OPTIONAL_SECTIONS = ['ansible_group_vars',
                      'cellv2_discovery',
                      'firewall_rules',
@@ -297,6 +313,19 @@ CONFIG_IMAGE_OVERRIDES = {
     'ContainerSwiftRingbuilderConfigImage': 'ContainerSwiftConfigImage'
 }
 
+# Parsed YAML documents, see load_yaml()
+_yaml_cache = {}
+# Files loaded or looked up since the last validate_file_tracked() call
+_loaded_files = set()
+# Content of the j2 templates rendered in memory, by absolute output path
+_rendered_files = {}
+# The RuleRecorder of the rule being run, see add_finding()
+_recorder = None
+
+# The code the results of the validators depend on
+VALIDATOR_SOURCES = tuple(os.path.abspath(path) for path in (
+    __file__, render.__file__, yaml_utils.__file__))
+
 SERVICE_NAME_OVERRIDE = {
     './deployment/rabbitmq/rabbitmq-messaging-pacemaker-puppet.yaml': 'rabbitmq',
 }
@@ -312,59 +341,152 @@ def to_camel_case(string):
                                                     s in string.split('_')))
 
 
-def get_base_endpoint_map(filename):
-    try:
-        with open(filename, 'r') as f:
-            tpl = yaml.load(f.read(), Loader=yaml.SafeLoader)
-        return tpl['parameters']['EndpointMap']['default']
-    except Exception:
-        print(traceback.format_exc())
-    return None
+def file_exists(filename):
+    """Whether a file is in the tree or was rendered in memory
 
+    Like the loaded files, the file is recorded as a dependency of the
+    validation, even when it does not exist.
+    """
+    path = os.path.abspath(filename)
+    _loaded_files.add(path)
+    return path in _rendered_files or os.path.exists(path)
 
-def get_endpoint_map_from_env(filename):
-    try:
-        with open(filename, 'r') as f:
-            tpl = yaml.load(f.read(), Loader=yaml.SafeLoader)
-        return {
-            'file': filename,
-            'map': tpl['parameter_defaults']['EndpointMap']
-        }
-    except Exception:
-        print(traceback.format_exc())
+
+def read_file(filename):
+    """Read a file, or get its content if it was rendered in memory"""
+    path = os.path.abspath(filename)
+    if path in _rendered_files:
+        return _rendered_files[path]
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def load_yaml(filename):
+    """Load a YAML file, parsing each file only once per run
+
+    The parsed documents are cached by path and modification time and shared
+    by all the validators, which must not modify them. Their mappings and
+    sequences keep the lines they were loaded from, see location().
+    """
+    path = os.path.abspath(filename)
+    _loaded_files.add(path)
+    # The rendered files do not change during a run
+    mtime = None if path in _rendered_files else os.stat(path).st_mtime
+    cached = _yaml_cache.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, yaml_utils.marked_load(read_file(path)))
+        _yaml_cache[path] = cached
+    return cached[1]
+
+
+def location(filename, data, key=None):
+    """Return filename:line for a node of a document loaded by load_yaml()
+
+    See yaml_utils.line_of() for data and key. Only the filename is
+    returned if the line is not known.
+    """
+    line = yaml_utils.line_of(data, key)
+    if line is None:
+        return filename
+    return '%s:%d' % (filename, line)
+
+
+SEVERITY_PREFIXES = {'error': 'ERROR: ', 'warning': 'Warning: ', 'note': ''}
+# The severities of the findings shown at each --quiet level
+QUIET_SEVERITIES = (('error', 'warning', 'note'), ('error', 'warning'),
+                    ('error',))
+
+
+def path_of(document, node):
+    """Return the keys leading to a node of a document, None if not in it
+
+    The node is looked up by identity, so that the mappings and sequences
+    merged by a validator are not found.
+    """
+    stack = [(document, [])]
+    while stack:
+        data, path = stack.pop()
+        if data is node:
+            return path
+        if isinstance(data, dict):
+            items = data.items()
+        elif isinstance(data, list):
+            items = enumerate(data)
+        else:
+            continue
+        stack.extend((value, path + [key]) for key, value in items
+                     if isinstance(value, (dict, list)))
     return None
 
 
-def validate_endpoint_map(base_map, env_map):
-    return sorted(base_map.keys()) == sorted(env_map.keys())
+def add_finding(severity, message, data=None, key=None, path=None,
+                filename=None, line=None):
+    """Report a finding of the rule being run
+
+    The findings of all the severities are recorded, the ones shown depend
+    on the --quiet level, see shown_findings().
+
+    :param severity: 'error', 'warning' or 'note'
+    :param data: The mapping or sequence loaded by load_yaml() the finding
+                 is about, its line and its path in the document are the
+                 ones of the finding
+    :param key: The key of data the finding is about, see location()
+    :param path: The keys leading to the node the finding is about, from
+                 the root of the document, when data is not in it
+    :param filename: The file the finding is about, the one being validated
+                     by default
+    :param line: The line of the finding, when data is not known
+    """
+    if data is not None:
+        if line is None:
+            line = yaml_utils.line_of(data, key)
+            if line is None:
+                line = yaml_utils.line_of(data)
+        if path is None:
+            path = path_of(load_yaml(filename or _recorder.filename), data)
+            if path is not None and key is not None:
+                path.append(key)
+    _recorder.add(severity, message, filename, line, path)
+
+
+def shown_findings(findings):
+    """Return the findings shown at the --quiet level of the run"""
+    severities = QUIET_SEVERITIES[min(args.quiet, len(QUIET_SEVERITIES) - 1)]
+    return [finding for finding in findings
+            if finding['severity'] in severities]
+
+
+def print_findings(findings):
+    for finding in findings:
+        print(SEVERITY_PREFIXES[finding['severity']] + finding['message'])
 
 
 def validate_role_name(filename):
-    with open(filename, 'r') as f:
-        tpl = yaml.load(f.read(), Loader=yaml.SafeLoader)
+    tpl = load_yaml(filename)
 
     role_data = tpl[0]
     if role_data['name'] != os.path.basename(filename).split('.')[0]:
-        print('ERROR: role name should match file name for role : %s.'
-              % filename)
+        add_finding('error', 'role name should match file name for role : '
+                    '%s.' % filename, role_data, 'name')
         return 1
     return 0
 
 
 def validate_hci_compute_services_default(env_filename, env_tpl):
-    env_services_list = env_tpl['parameter_defaults']['ComputeServices']
+    env_services_list = list(env_tpl['parameter_defaults']['ComputeServices'])
     env_services_list.remove('OS::TripleO::Services::CephOSD')
     roles_filename = os.path.join(os.path.dirname(env_filename),
                                   '../roles/Compute.yaml')
-    with open(roles_filename, 'r') as f:
-        roles_tpl = yaml.load(f.read(), Loader=yaml.SafeLoader)
+    roles_tpl = load_yaml(roles_filename)
 
     for role in roles_tpl:
         if role['name'] == 'Compute':
             roles_services_list = role['ServicesDefault']
             if sorted(env_services_list) != sorted(roles_services_list):
-                print('ERROR: ComputeServices in %s is different from '
-                      'ServicesDefault in roles/Compute.yaml' % env_filename)
+                add_finding('error', 'ComputeServices in %s is different '
+                            'from ServicesDefault in roles/Compute.yaml'
+                            % env_filename, env_tpl['parameter_defaults'],
+                            'ComputeServices')
                 return 1
     return 0
 
@@ -372,17 +494,17 @@ def validate_hci_compute_services_default(env_filename, env_tpl):
 def validate_hci_computehci_role(hci_role_filename, hci_role_tpl):
     compute_role_filename = os.path.join(os.path.dirname(hci_role_filename),
                                          './Compute.yaml')
-    with open(compute_role_filename, 'r') as f:
-        compute_role_tpl = yaml.load(f.read(), Loader=yaml.SafeLoader)
+    compute_role_tpl = load_yaml(compute_role_filename)
 
     compute_role_services = compute_role_tpl[0]['ServicesDefault']
     for role in hci_role_tpl:
         if role['name'] == 'ComputeHCI':
-            hci_role_services = role['ServicesDefault']
+            hci_role_services = list(role['ServicesDefault'])
             hci_role_services.remove('OS::TripleO::Services::CephOSD')
             if sorted(hci_role_services) != sorted(compute_role_services):
-                print('ERROR: ServicesDefault in %s is different from '
-                      'ServicesDefault in roles/Compute.yaml' % hci_role_filename)
+                add_finding('error', 'ServicesDefault in %s is different '
+                            'from ServicesDefault in roles/Compute.yaml'
+                            % hci_role_filename, role, 'ServicesDefault')
                 return 1
     return 0
 
@@ -390,16 +512,16 @@ def validate_hci_computehci_role(hci_role_filename, hci_role_tpl):
 def validate_controller_dashboard(filename, tpl):
     control_role_filename = os.path.join(os.path.dirname(filename),
                                          './Controller.yaml')
-    with open(control_role_filename, 'r') as f:
-        control_role_tpl = yaml.load(f.read(), Loader=yaml.SafeLoader)
+    control_role_tpl = load_yaml(control_role_filename)
 
     control_role_services = control_role_tpl[0]['ServicesDefault']
     for role in tpl:
         if role['name'] == 'ControllerStorageDashboard':
             services = role['ServicesDefault']
             if sorted(services) != sorted(control_role_services):
-                print('ERROR: ServicesDefault in %s is different from '
-                      'ServicesDefault in roles/Controller.yaml' % filename)
+                add_finding('error', 'ServicesDefault in %s is different '
+                            'from ServicesDefault in roles/Controller.yaml'
+                            % filename, role, 'ServicesDefault')
                 return 1
     return 0
 
@@ -407,16 +529,16 @@ def validate_controller_dashboard(filename, tpl):
 def validate_controller_storage_nfs(filename, tpl, exclude_service=()):
     control_role_filename = os.path.join(os.path.dirname(filename),
                                          './Controller.yaml')
-    with open(control_role_filename, 'r') as f:
-        control_role_tpl = yaml.load(f.read(), Loader=yaml.SafeLoader)
+    control_role_tpl = load_yaml(control_role_filename)
 
     control_role_services = control_role_tpl[0]['ServicesDefault']
     for role in tpl:
         if role['name'] == 'ControllerStorageNfs':
             services = [x for x in role['ServicesDefault'] if (x not in exclude_service)]
             if sorted(services) != sorted(control_role_services):
-                print('ERROR: ServicesDefault in %s is different from '
-                      'ServicesDefault in roles/Controller.yaml' % filename)
+                add_finding('error', 'ServicesDefault in %s is different '
+                            'from ServicesDefault in roles/Controller.yaml'
+                            % filename, role, 'ServicesDefault')
                 return 1
     return 0
 
@@ -426,13 +548,12 @@ def validate_hci_role(hci_role_filename, hci_role_tpl):
     if hci_role_filename in ['./roles/' + x + '.yaml' for x in role_files]:
         compute_role_filename = \
             os.path.join(os.path.dirname(hci_role_filename), './Compute.yaml')
-        with open(compute_role_filename, 'r') as f:
-            compute_role_tpl = yaml.load(f.read(), Loader=yaml.SafeLoader)
+        compute_role_tpl = load_yaml(compute_role_filename)
 
         compute_role_services = compute_role_tpl[0]['ServicesDefault']
         for role in hci_role_tpl:
             if role['name'] == 'HciCephAll':
-                hci_role_services = role['ServicesDefault']
+                hci_role_services = list(role['ServicesDefault'])
                 hci_role_services.remove('OS::TripleO::Services::CephGrafana')
                 hci_role_services.remove('OS::TripleO::Services::CephMds')
                 hci_role_services.remove('OS::TripleO::Services::CephMgr')
@@ -441,21 +562,22 @@ def validate_hci_role(hci_role_filename, hci_role_tpl):
                 hci_role_services.remove('OS::TripleO::Services::CephRgw')
                 hci_role_services.remove('OS::TripleO::Services::CephOSD')
             if role['name'] == 'HciCephFile':
-                hci_role_services = role['ServicesDefault']
+                hci_role_services = list(role['ServicesDefault'])
                 hci_role_services.remove('OS::TripleO::Services::CephMds')
                 hci_role_services.remove('OS::TripleO::Services::CephOSD')
             if role['name'] == 'HciCephMon':
-                hci_role_services = role['ServicesDefault']
+                hci_role_services = list(role['ServicesDefault'])
                 hci_role_services.remove('OS::TripleO::Services::CephMgr')
                 hci_role_services.remove('OS::TripleO::Services::CephMon')
                 hci_role_services.remove('OS::TripleO::Services::CephOSD')
             if role['name'] == 'HciCephObject':
-                hci_role_services = role['ServicesDefault']
+                hci_role_services = list(role['ServicesDefault'])
                 hci_role_services.remove('OS::TripleO::Services::CephRgw')
                 hci_role_services.remove('OS::TripleO::Services::CephOSD')
             if sorted(hci_role_services) != sorted(compute_role_services):
-                print('ERROR: ServicesDefault in %s is different from '
-                      'ServicesDefault in roles/Compute.yaml' % hci_role_filename)
+                add_finding('error', 'ServicesDefault in %s is different '
+                            'from ServicesDefault in roles/Compute.yaml'
+                            % hci_role_filename, role, 'ServicesDefault')
                 return 1
     return 0
 
@@ -465,13 +587,12 @@ def validate_ceph_role(ceph_role_filename, ceph_role_tpl):
     if ceph_role_filename in ['./roles/' + x + '.yaml' for x in role_files]:
         ceph_storage_role_filename = \
             os.path.join(os.path.dirname(ceph_role_filename), './CephStorage.yaml')
-        with open(ceph_storage_role_filename, 'r') as f:
-            ceph_storage_role_tpl = yaml.load(f.read(), Loader=yaml.SafeLoader)
+        ceph_storage_role_tpl = load_yaml(ceph_storage_role_filename)
 
         ceph_storage_role_services = ceph_storage_role_tpl[0]['ServicesDefault']
         for role in ceph_role_tpl:
             if role['name'] == 'CephAll':
-                ceph_role_services = role['ServicesDefault']
+                ceph_role_services = list(role['ServicesDefault'])
                 ceph_role_services.remove('OS::TripleO::Services::CephGrafana')
                 ceph_role_services.remove('OS::TripleO::Services::CephMds')
                 ceph_role_services.remove('OS::TripleO::Services::CephMgr')
@@ -479,16 +600,17 @@ def validate_ceph_role(ceph_role_filename, ceph_role_tpl):
                 ceph_role_services.remove('OS::TripleO::Services::CephRbdMirror')
                 ceph_role_services.remove('OS::TripleO::Services::CephRgw')
             if role['name'] == 'CephFile':
-                ceph_role_services = role['ServicesDefault']
+                ceph_role_services = list(role['ServicesDefault'])
                 ceph_role_services.remove('OS::TripleO::Services::CephClient')
                 ceph_role_services.remove('OS::TripleO::Services::CephMds')
             if role['name'] == 'CephObject':
-                ceph_role_services = role['ServicesDefault']
+                ceph_role_services = list(role['ServicesDefault'])
                 ceph_role_services.remove('OS::TripleO::Services::CephClient')
                 ceph_role_services.remove('OS::TripleO::Services::CephRgw')
             if sorted(ceph_role_services) != sorted(ceph_storage_role_services):
-                print('ERROR: ServicesDefault in %s is different from '
-                      'ServicesDefault in roles/Ceph_storage.yaml' % ceph_role_filename)
+                add_finding('error', 'ServicesDefault in %s is different '
+                            'from ServicesDefault in roles/Ceph_storage.yaml'
+                            % ceph_role_filename, role, 'ServicesDefault')
                 return 1
     return 0
 
@@ -496,13 +618,12 @@ def validate_ceph_role(ceph_role_filename, ceph_role_tpl):
 def validate_controller_no_ceph_role(filename, tpl):
     control_role_filename = os.path.join(os.path.dirname(filename),
                                          './Controller.yaml')
-    with open(control_role_filename, 'r') as f:
-        control_role_tpl = yaml.load(f.read(), Loader=yaml.SafeLoader)
+    control_role_tpl = load_yaml(control_role_filename)
 
     control_role_services = control_role_tpl[0]['ServicesDefault']
     for role in tpl:
         if role['name'] == 'ControllerNoCeph':
-            services = role['ServicesDefault']
+            services = list(role['ServicesDefault'])
             services.remove('OS::TripleO::Services::CephClient')
             services.append('OS::TripleO::Services::CephMds')
             services.append('OS::TripleO::Services::CephMgr')
@@ -511,8 +632,9 @@ def validate_controller_no_ceph_role(filename, tpl):
             services.append('OS::TripleO::Services::CephRbdMirror')
             services.append('OS::TripleO::Services::CephRgw')
             if sorted(services) != sorted(control_role_services):
-                print('ERROR: ServicesDefault in %s is different from '
-                      'ServicesDefault in roles/Controller.yaml' % filename)
+                add_finding('error', 'ServicesDefault in %s is different '
+                            'from ServicesDefault in roles/Controller.yaml'
+                            % filename, role, 'ServicesDefault')
                 return 1
     return 0
 
@@ -520,8 +642,7 @@ def validate_controller_no_ceph_role(filename, tpl):
 def validate_with_compute_role_services(role_filename, role_tpl, exclude_service=()):
     cmpt_filename = os.path.join(os.path.dirname(role_filename),
                                  './Compute.yaml')
-    with open(cmpt_filename, 'r') as f:
-        cmpt_tpl = yaml.load(f.read(), Loader=yaml.SafeLoader)
+    cmpt_tpl = load_yaml(cmpt_filename)
 
     cmpt_services = cmpt_tpl[0]['ServicesDefault']
     cmpt_services = [x for x in cmpt_services if (x not in exclude_service)]
@@ -529,9 +650,10 @@ def validate_with_compute_role_services(role_filename, role_tpl, exclude_service
     role_services = set(role_tpl[0]['ServicesDefault'])
     missing_services = list(set(cmpt_services) - role_services)
     if missing_services:
-        print('ERROR: ServicesDefault in {0} is missing services [{1}] from '
-              'ServicesDefault in roles/Compute.yaml'.format(role_filename,
-              ', '.join(missing_services)))
+        add_finding('error', 'ServicesDefault in {0} is missing services '
+                    '[{1}] from ServicesDefault in roles/Compute.yaml'.format(
+                        role_filename, ', '.join(missing_services)),
+                    role_tpl[0], 'ServicesDefault')
         return 1
 
     cmpt_us = cmpt_tpl[0].get('update_serial', None)
@@ -539,18 +661,18 @@ def validate_with_compute_role_services(role_filename, role_tpl, exclude_service
 
     if 'OS::TripleO::Services::CephOSD' in role_services:
         if tpl_us not in (None, 1):
-            print('ERROR: update_serial in {0} ({1}) '
-                  'is should be 1 as it includes CephOSD {2}'.format(
-                      role_filename,
-                      tpl_us,
-                      cmpt_us))
+            add_finding('error', 'update_serial in {0} ({1}) '
+                        'is should be 1 as it includes CephOSD {2}'.format(
+                            role_filename,
+                            tpl_us,
+                            cmpt_us), role_tpl[0], 'update_serial')
             return 1
     elif cmpt_us is not None and tpl_us != cmpt_us:
-        print('ERROR: update_serial in {0} ({1}) '
-              'does not match roles/Compute.yaml {2}'.format(
-                  role_filename,
-                  tpl_us,
-                  cmpt_us))
+        add_finding('error', 'update_serial in {0} ({1}) '
+                    'does not match roles/Compute.yaml {2}'.format(
+                        role_filename,
+                        tpl_us,
+                        cmpt_us), role_tpl[0], 'update_serial')
         return 1
 
     return 0
@@ -565,21 +687,26 @@ def validate_multiarch_compute_roles(role_filename, role_tpl):
     for arch in ['ppc64le']:
         arch_filename = os.path.join(roles_dir,
                                      'Compute%s.yaml' % (arch.upper()))
-        with open(arch_filename, 'r') as f:
-            arch_tpl = yaml.safe_load(f)
+        arch_tpl = load_yaml(arch_filename)
 
         arch_services = set(arch_tpl[0].get('ServicesDefault', []))
         if compute_services != arch_services:
-            print('ERROR ServicesDefault in %s and %s do not match' %
-                  (role_filename, arch_filename))
-            print('ERROR problems with: %s' % (','.join(compute_services.symmetric_difference(arch_services))))
+            add_finding('error', 'ServicesDefault in %s and %s do not match'
+                        '\nproblems with: %s'
+                        % (role_filename, arch_filename,
+                           ','.join(compute_services.symmetric_difference(
+                               arch_services))),
+                        role_tpl[0], 'ServicesDefault')
             errors = 1
 
         arch_networks = arch_tpl[0].get('networks', [])
         if compute_networks != arch_networks:
-            print('ERROR networks in %s and %s do not match' %
-                  (role_filename, arch_filename))
-            print('ERROR problems with: %s' % (','.join(compute_networks.symmetric_difference(arch_networks))))
+            add_finding('error', 'networks in %s and %s do not match'
+                        '\nproblems with: %s'
+                        % (role_filename, arch_filename,
+                           ','.join(compute_networks.symmetric_difference(
+                               arch_networks))),
+                        role_tpl[0], 'networks')
             errors = 1
 
     return errors
@@ -656,11 +783,10 @@ def validate_docker_service_mysql_usage(filename, tpl):
                     continue
                 newfilename = \
                     os.path.normpath(os.path.join(os.path.dirname(incfile), f))
-                if not os.path.exists(newfilename) and \
-                    os.path.exists(newfilename.replace('.yaml', '.j2.yaml')):
+                if not file_exists(newfilename) and \
+                    file_exists(newfilename.replace('.yaml', '.j2.yaml')):
                     return  # Skip for now if it's templated
-                with open(newfilename, 'r') as newfile:
-                    newtmp = yaml.load(newfile.read(), Loader=yaml.SafeLoader)
+                newtmp = load_yaml(newfilename)
                 read_all(newfilename, newtmp)
 
     read_all(filename, tpl)
@@ -670,9 +796,9 @@ def validate_docker_service_mysql_usage(filename, tpl):
         mysqlclient = [x for x in resources
                        if resources[x]['type'].endswith('mysql-client.yaml')]
         if len(mysqlclient) == 0:
-            print("ERROR: containerized service %s uses mysql but "
-                  "resource mysql-client.yaml is not used"
-                  % filename)
+            add_finding('error', "containerized service %s uses mysql but "
+                        "resource mysql-client.yaml is not used"
+                        % filename, tpl, 'resources')
             return 1
 
         # and that mysql::client puppet module is included in puppet-config
@@ -681,10 +807,11 @@ def validate_docker_service_mysql_usage(filename, tpl):
         role_data = tpl['outputs']['role_data']
         puppet_config = role_data['value']['puppet_config']['step_config']
         if not search(puppet_config, match_mysqlclient, no_op):
-            print("ERROR: containerized service %s uses mysql but "
-                  "puppet_config section does not include "
-                  "tripleo::profile::base::database::mysql::client"
-                  % filename)
+            add_finding('error', "containerized service %s uses mysql but "
+                        "puppet_config section does not include "
+                        "tripleo::profile::base::database::mysql::client"
+                        % filename, role_data['value']['puppet_config'],
+                        'step_config')
             return 1
 
     return 0
@@ -693,8 +820,8 @@ def validate_docker_service_mysql_usage(filename, tpl):
 def validate_docker_service(filename, tpl):
     if 'outputs' in tpl and 'role_data' in tpl['outputs']:
         if 'value' not in tpl['outputs']['role_data']:
-            print('ERROR: invalid role_data for filename: %s'
-                  % filename)
+            add_finding('error', 'invalid role_data for filename: %s'
+                        % filename, tpl['outputs'], 'role_data')
             return 1
         role_data = tpl['outputs']['role_data']['value']
         if list(role_data.keys()) == ['map_merge']:
@@ -712,11 +839,13 @@ def validate_docker_service(filename, tpl):
                 # additional step_config to add pacemaker resources
                 if (section_name == 'docker_config' and
                         role_data.get('step_config', '')):
-                    print('ERROR: %s appears to be a barematal-puppet service'
-                        % (filename))
+                    add_finding('error', '%s appears to be a '
+                                'barematal-puppet service' % filename,
+                                tpl['outputs']['role_data'], 'value')
                     return 1
-                print('ERROR: %s is required in role_data for %s.'
-                      % (section_name, filename))
+                add_finding('error', '%s is required in role_data for %s.'
+                            % (section_name, filename),
+                            tpl['outputs']['role_data'], 'value')
                 return 1
 
         for section_name in role_data.keys():
@@ -727,23 +856,26 @@ def validate_docker_service(filename, tpl):
                     # check for LP##1768019
                     if section_name in ANSIBLE_TASKS_SECTIONS and \
                             role_data.get(section_name) == {}:
-                        print('ERROR: %s cannot be an empty dict. If not '
-                              'required please consider removing remove this '
-                              'option or setting it to [] or null' %
-                              section_name)
+                        add_finding('error', '%s cannot be an empty dict. '
+                                    'If not required please consider removing '
+                                    'remove this option or setting it to [] '
+                                    'or null' % section_name,
+                                    role_data, section_name)
                         return 1
                     continue
                 elif section_name in OPTIONAL_SECTIONS:
                     continue
                 else:
-                    print('ERROR: %s is extra in role_data for %s.'
-                          % (section_name, filename))
+                    add_finding('error', '%s is extra in role_data for %s.'
+                                % (section_name, filename),
+                                role_data, section_name)
                     return 1
 
         if 'puppet_config' in role_data:
             if validate_docker_service_mysql_usage(filename, tpl):
-                print('ERROR: could not validate use of mysql service for %s.'
-                      % filename)
+                add_finding('error', 'could not validate use of mysql '
+                            'service for %s.' % filename,
+                            role_data, 'puppet_config')
                 return 1
             puppet_config = role_data['puppet_config']
             for key in puppet_config:
@@ -753,13 +885,15 @@ def validate_docker_service(filename, tpl):
                     if key in OPTIONAL_DOCKER_PUPPET_CONFIG_SECTIONS:
                         continue
                     else:
-                        print('ERROR: %s should not be in puppet_config section.'
-                              % key)
+                        add_finding('error', '%s should not be in '
+                                    'puppet_config section.' % key,
+                                    puppet_config, key)
                         return 1
             for key in REQUIRED_DOCKER_PUPPET_CONFIG_SECTIONS:
                 if key not in puppet_config:
-                    print('ERROR: %s is required in puppet_config for %s.'
-                          % (key, filename))
+                    add_finding('error', '%s is required in puppet_config '
+                                'for %s.' % (key, filename),
+                                role_data, 'puppet_config')
                     return 1
 
             config_volume = puppet_config.get('config_volume')
@@ -770,8 +904,11 @@ def validate_docker_service(filename, tpl):
                 expected_config_image_parameter
             )
             if config_volume and expected_config_image_parameter not in tpl.get('parameters', []):
-                print('ERROR: Missing %s heat parameter for %s config_volume.'
-                      % (expected_config_image_parameter, config_volume))
+                add_finding('error', 'Missing %s heat parameter for %s '
+                            'config_volume.'
+                            % (expected_config_image_parameter,
+                               config_volume),
+                            puppet_config, 'config_volume')
                 return 1
 
         if 'docker_config' in role_data:
@@ -790,35 +927,41 @@ def validate_docker_service(filename, tpl):
                         command = ' '.join(map(str, command))
                     if 'bootstrap_host_exec' in command \
                             and container.get('user') != 'root':
-                        print('ERROR: bootstrap_host_exec needs to run '
-                              'as the root user.')
+                        add_finding('error', 'bootstrap_host_exec needs to '
+                                    'run as the root user.',
+                                    container, 'command')
                         return 1
 
         if 'upgrade_tasks' in role_data and role_data['upgrade_tasks']:
-            if (validate_upgrade_tasks(role_data['upgrade_tasks']) or
-                validate_upgrade_tasks_duplicate_whens(filename)):
-                print('ERROR: upgrade_tasks validation failed')
+            if (validate_upgrade_tasks(role_data['upgrade_tasks'],
+                                       filename) or
+                validate_upgrade_tasks_duplicate_whens(
+                    filename, role_data['upgrade_tasks'])):
+                add_finding('error', 'upgrade_tasks validation failed',
+                            role_data, 'upgrade_tasks')
                 return 1
 
     if 'parameters' in tpl:
         for param in required_params:
             if param not in tpl['parameters']:
-                print('ERROR: parameter %s is required for %s.'
-                      % (param, filename))
+                add_finding('error', 'parameter %s is required for %s.'
+                            % (param, filename), tpl, 'parameters')
                 return 1
     return 0
 
 
 def validate_docker_logging_template(filename, tpl):
     if 'outputs' not in tpl:
-        print('ERROR: outputs are missing from: %s' % filename)
+        add_finding('error', 'outputs are missing from: %s' % filename,
+                    tpl)
         return 1
     missing_entries = [
         entry for entry in REQUIRED_DOCKER_LOGGING_OUTPUTS
         if entry not in tpl['outputs']]
     if any(missing_entries):
-        print('ERROR: The file %s is missing the following output(s):'
-              ' %s' % (filename, ', '.join(missing_entries)))
+        add_finding('error', 'The file %s is missing the following '
+                    'output(s): %s' % (filename, ', '.join(missing_entries)),
+                    tpl, 'outputs')
         return 1
     return 0
 
@@ -826,13 +969,14 @@ def validate_docker_logging_template(filename, tpl):
 def validate_service(filename, tpl):
     if 'outputs' in tpl and 'role_data' in tpl['outputs']:
         if 'value' not in tpl['outputs']['role_data']:
-            print('ERROR: invalid role_data for filename: %s'
-                  % filename)
+            add_finding('error', 'invalid role_data for filename: %s'
+                        % filename, tpl['outputs'], 'role_data')
             return 1
         role_data = tpl['outputs']['role_data']['value']
         if 'service_name' not in role_data:
-            print('ERROR: service_name is required in role_data for %s.'
-                  % filename)
+            add_finding('error', 'service_name is required in role_data '
+                        'for %s.' % filename, tpl['outputs']['role_data'],
+                        'value')
             return 1
         # service_name must match the beginning of the file name, but with an underscore
         service_name = \
@@ -841,27 +985,33 @@ def validate_service(filename, tpl):
         if is_string(role_data['service_name']):
             service_name = SERVICE_NAME_OVERRIDE.get(filename, service_name)
             if not role_data['service_name'].startswith(service_name):
-                print('ERROR: service_name "%s" should match the beginning of the '
-                      'filename: %s (%s).'
-                      % (role_data['service_name'], os.path.basename(filename), service_name))
+                add_finding('error', 'service_name "%s" should match the '
+                            'beginning of the filename: %s (%s).'
+                            % (role_data['service_name'],
+                               os.path.basename(filename), service_name),
+                            role_data, 'service_name')
                 return 1
         # if service connects to mysql, the uri should use option
         # bind_address to avoid issues with VIP failover
         if 'config_settings' in role_data and \
            validate_mysql_connection(role_data['config_settings']):
-            print('ERROR: mysql connection uri should use option bind_address')
+            add_finding('error', 'mysql connection uri should use option '
+                        'bind_address', role_data, 'config_settings')
             return 1
         if 'upgrade_tasks' in role_data and role_data['upgrade_tasks']:
-            if (validate_upgrade_tasks(role_data['upgrade_tasks']) or
-                validate_upgrade_tasks_duplicate_whens(filename)):
-                print('ERROR: upgrade_tasks validation failed')
+            if (validate_upgrade_tasks(role_data['upgrade_tasks'],
+                                       filename) or
+                validate_upgrade_tasks_duplicate_whens(
+                    filename, role_data['upgrade_tasks'])):
+                add_finding('error', 'upgrade_tasks validation failed',
+                            role_data, 'upgrade_tasks')
                 return 1
 
     if 'parameters' in tpl:
         for param in required_params:
             if param not in tpl['parameters']:
-                print('ERROR: parameter %s is required for %s.'
-                      % (param, filename))
+                add_finding('error', 'parameter %s is required for %s.'
+                            % (param, filename), tpl, 'parameters')
                 return 1
     return 0
 
@@ -961,6 +1111,14 @@ def _get(d, path):
     return d
 
 
+STR_REPLACE_PARAMS_NET_RE = re.compile(
+    r'(\\)?;str(\\)?_replace(\\)?;params(\\)?;\S*?net', re.IGNORECASE)
+NETWORK_NAME_KEY_RE = re.compile(r'(?!ip|cidr|addr|bind|host)([^;]\S)*?net',
+                                 re.IGNORECASE)
+MAP_GET_PARAM_RE = re.compile(r'Map.*get(\\)?_param')
+SERVICE_NET_MAP_RE = re.compile('ServiceNetMap')
+
+
 def validate_service_hiera_interpol(f, tpl):
     """Validate service templates for hiera interpolation rules
 
@@ -983,7 +1141,7 @@ def validate_service_hiera_interpol(f, tpl):
     enter_lists = True
     if 'outputs' in tpl and 'role_data' in tpl['outputs']:
         values_found = _rsearch_keys(tpl['outputs']['role_data'],
-                                     'ServiceNetMap',
+                                     SERVICE_NET_MAP_RE,
                                      search_keynames, enter_lists)
         for path in values_found:
             # Omit if external deploy tasks in the path
@@ -1015,19 +1173,15 @@ def validate_service_hiera_interpol(f, tpl):
             # name. The only exception is allow anything under
             # str_replace['params'] ('str_replace;params' in the str notation).
             # We need to escape because of '$' char may be in templated params.
-            query = re.compile(r'(\\)?;str(\\)?_replace(\\)?;params(\\)?;\S*?net',
-                               re.IGNORECASE)
-            if not query.search(re.escape(path_str)):
+            if not STR_REPLACE_PARAMS_NET_RE.search(re.escape(path_str)):
                 # Keep parsing, if foo_vip_network, or anything
                 # else that looks like a keystore for an IP address value.
-                query = re.compile(r'(?!ip|cidr|addr|bind|host)([^;]\S)*?net',
-                                   re.IGNORECASE)
-                if query.search(re.escape(path_str)):
+                if NETWORK_NAME_KEY_RE.search(re.escape(path_str)):
                     continue
 
             # Omit mappings in tht, like:
             # [NetXxxMap, <... ,> {get_param: [ServiceNetMap, ...
-            if re.search(r'Map.*get(\\)?_param', re.escape(path_str)):
+            if MAP_GET_PARAM_RE.search(re.escape(path_str)):
                 continue
 
             # For the remaining cases, verify if there is a template
@@ -1036,9 +1190,10 @@ def validate_service_hiera_interpol(f, tpl):
             str_replace_pos = _getindex(path, 'str_replace')
             params_pos = _getindex(path, 'params')
             if str_replace_pos is None or params_pos is None:
-                print("ERROR: Missed hiera interpolation via str_replace "
-                      "in %s, role_data: %s"
-                      % (f, path))
+                add_finding('error', "Missed hiera interpolation via "
+                            "str_replace in %s, role_data: %s" % (f, path),
+                            _get(tpl['outputs']['role_data'], path[:-1]),
+                            path[-1], ['outputs', 'role_data'] + path)
                 failed = True
                 continue
 
@@ -1050,9 +1205,11 @@ def validate_service_hiera_interpol(f, tpl):
                                      re.escape(param_name),
                                      str_replace['template'])
             if str_replace['template'] is None or match_interp is None:
-                print("ERROR: Missed %%{hiera('... %s ...')} interpolation "
-                      "in str_replace['template'] "
-                      "in %s, role_data: %s" % (param_name, f, path))
+                add_finding('error', "Missed %%{hiera('... %s ...')} "
+                            "interpolation in str_replace['template'] "
+                            "in %s, role_data: %s" % (param_name, f, path),
+                            _get(tpl['outputs']['role_data'], path[:-1]),
+                            path[-1], ['outputs', 'role_data'] + path)
                 failed = True
                 continue
             # end processing this path and go for the next one
@@ -1063,31 +1220,108 @@ def validate_service_hiera_interpol(f, tpl):
         return 0
 
 
-def validate_upgrade_tasks_duplicate_whens(filename):
-    """Take a heat template and starting at the upgrade_tasks
-       try to detect duplicate 'when:' statements
+def validate_upgrade_tasks_duplicate_whens(filename, upgrade_tasks):
+    """Take the upgrade_tasks of a heat template and try to detect
+       duplicate 'when:' statements
+
+    Only the last one is kept in the loaded tasks, the loader records the
+    others.
     """
-    with open(filename, 'r') as template:
-        contents = template.read()
-        upgrade_task_position = contents.index('upgrade_tasks')
-        lines = contents[upgrade_task_position:].splitlines()
-        count = 0
-        duplicate = ''
-        for line in lines:
-            if '  when:' in line:
-                count += 1
-                if count > 1:
-                    print("ERROR: found duplicate when statements in %s "
-                          "upgrade_task: %s %s" % (filename, line, duplicate))
-                    return 1
-                duplicate = line
-            elif ' -' in line:
-                count = 0
-                duplicate = ''
+    # some templates define its upgrade_tasks via list_concat
+    if isinstance(upgrade_tasks, dict):
+        if upgrade_tasks.get('list_concat'):
+            return validate_upgrade_tasks_duplicate_whens(
+                filename, upgrade_tasks['list_concat'][1])
         return 0
 
+    for task in upgrade_tasks:
+        if not isinstance(task, dict):
+            continue
+        for key, line in getattr(task, 'duplicate_keys', ()):
+            if key == 'when':
+                add_finding('error', "found duplicate when statements in "
+                            "%s:%d upgrade_task: %s"
+                            % (filename, line, task.get('name', '')),
+                            task, 'when', line=line)
+                return 1
+        for block in ('block', 'rescue', 'always'):
+            if isinstance(task.get(block), list) and \
+                    validate_upgrade_tasks_duplicate_whens(filename,
+                                                           task[block]):
+                return 1
+    return 0
+
 
-def validate(filename, param_map):
+def get_param_references(tpl):
+    """Return the names of the parameters referenced by a Heat template
+
+    These are the parameters of the get_param functions found in the
+    resources, outputs and conditions, including the get_param functions
+    nested in the arguments of other functions, e.g.
+    {get_param: [ServiceNetMap, {get_param: NetworkName}]}, and the
+    parameters listed in the parameter_groups.
+    """
+    references = set()
+    nodes = [tpl.get(section) for section in ('resources', 'outputs',
+                                              'conditions')]
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, dict):
+            param = node.get('get_param')
+            if isinstance(param, list) and param:
+                param = param[0]
+            if is_string(param):
+                references.add(param)
+            nodes.extend(node.values())
+        elif isinstance(node, list):
+            nodes.extend(node)
+    for group in tpl.get('parameter_groups') or []:
+        if isinstance(group, dict):
+            references.update(group.get('parameters') or [])
+    return references
+
+
+class RuleRecorder(object):
+    """Collect the findings of the rules run on a file and their run time
+
+    The rules report their findings with add_finding(), which adds them to
+    the recorder of the rule being run.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.findings = []
+        self.timings = collections.OrderedDict()
+        self.failed_rule = None
+        self._rule = None
+
+    def add(self, severity, message, filename=None, line=None, path=None):
+        """Add a finding of the rule being run, see add_finding()"""
+        self.findings.append({'file': filename or self.filename,
+                              'rule': self._rule, 'severity': severity,
+                              'path': path, 'line': line,
+                              'message': message})
+
+    @contextlib.contextmanager
+    def rule(self, rule_id):
+        """Run a block as the rule rule_id"""
+        global _recorder
+        previous = (_recorder, self._rule)
+        _recorder, self._rule = self, rule_id
+        start = time.time()
+        try:
+            yield
+        except Exception:
+            # The traceback is reported by the caller
+            self.failed_rule = rule_id
+            raise
+        finally:
+            self.timings[rule_id] = (self.timings.get(rule_id, 0) +
+                                     time.time() - start)
+            _recorder, self._rule = previous
+
+
+def validate(filename, param_map, recorder=None):
     """Validate a Heat template
 
     :param filename: The path to the file to validate
@@ -1110,222 +1344,154 @@ def validate(filename, param_map):
                                 },
                                 ...
                            ]}
+    :param recorder: A RuleRecorder collecting the findings and the run time
+                     of the rules, a new one is used by default
     Returns a global retval that indicates any failures had been in the check progress.
     """
-    if args.quiet < 1:
-        print('Validating %s' % filename)
+    if recorder is None:
+        recorder = RuleRecorder(filename)
     retval = 0
     try:
-        with open(filename, 'r') as f:
-            tpl = yaml.load(f.read(), Loader=yaml.SafeLoader)
+        with recorder.rule('yaml_syntax'):
+            tpl = load_yaml(filename)
 
         is_heat_template = 'heat_template_version' in tpl
 
         # The template version should be in the list of supported versions for the current release.
         # This validation will be applied to all templates not just for those in the services folder.
         if is_heat_template:
-            tpl_template_version = str(tpl['heat_template_version'])
-
-            if tpl_template_version not in valid_heat_template_versions:
-                print('ERROR: heat_template_version in template %s '
-                      'is not valid: %s (allowed values %s)'
-                    % (
-                        filename,
-                        tpl_template_version,
-                        ', '.join(valid_heat_template_versions)
+            with recorder.rule('heat_template_version'):
+                tpl_template_version = str(tpl['heat_template_version'])
+
+                if tpl_template_version not in valid_heat_template_versions:
+                    add_finding(
+                        'error', 'heat_template_version in template %s '
+                        'is not valid: %s (allowed values %s)'
+                        % (
+                            filename,
+                            tpl_template_version,
+                            ', '.join(valid_heat_template_versions)
+                        ), tpl, 'heat_template_version'
                     )
-                )
-                return 1
-            if tpl_template_version != current_heat_template_version \
-                    and args.quiet < 2:
-                print('Warning: heat_template_version in template %s '
-                      'is outdated: %s (current %s)'
-                    % (
-                        filename,
-                        tpl_template_version,
-                        current_heat_template_version
+                    return 1
+                if tpl_template_version != current_heat_template_version:
+                    add_finding(
+                        'warning', 'heat_template_version in template %s '
+                        'is outdated: %s (current %s)'
+                        % (
+                            filename,
+                            tpl_template_version,
+                            current_heat_template_version
+                        ), tpl, 'heat_template_version'
                     )
-                )
-
-        if VALIDATE_PUPPET_OVERRIDE.get(filename, False) or (
-                re.search(r'^\.\/deployment\/.+-(baremetal|pacemaker)-puppet.yaml$', filename) and
-                VALIDATE_PUPPET_OVERRIDE.get(filename, True)):
-            retval |= validate_service(filename, tpl)
-
-        if re.search(r'(puppet|docker)\/services', filename) or \
-                re.search(r'^\.\/deployment\/', filename):
-            retval |= validate_service_hiera_interpol(filename, tpl)
-
-        if re.search(r'^\.\/deployment\/logging\/(files|stdout)\/', filename):
-            retval |= validate_docker_logging_template(filename, tpl)
-        elif VALIDATE_DOCKER_OVERRIDE.get(filename, False) or (
-                re.search(r'^\.\/deployment\/.+-container-puppet.yaml$', filename) and
-                VALIDATE_DOCKER_OVERRIDE.get(filename, True)):
-            retval |= validate_docker_service(filename, tpl)
-
-        if filename.endswith('hyperconverged-ceph.yaml'):
-            retval |= validate_hci_compute_services_default(filename, tpl)
-
-        if filename.startswith('./roles/'):
-            retval = validate_role_name(filename)
-
-        if filename.startswith('./roles/ComputeHCI.yaml') or \
-                filename.startswith('./roles/ComputeHCIOvsDpdk.yaml') or \
-                filename.startswith('./roles/ComputeHCISriov.yaml'):
-            retval |= validate_hci_computehci_role(filename, tpl)
-
-        if filename.startswith('./roles/ControllerStorageNfs.yaml'):
-            exclude = [
-                'OS::TripleO::Services::CephNfs']
-            retval |= validate_controller_storage_nfs(filename, tpl, exclude)
-
-        if filename.startswith('./roles/ControllerStorageDashboard.yaml'):
-            retval |= validate_controller_dashboard(filename, tpl)
-
-        if filename.startswith('./roles/ComputeOvsDpdk.yaml') or \
-                filename.startswith('./roles/ComputeSriov.yaml') or \
-                filename.startswith('./roles/ComputeOvsDpdkRT.yaml') or \
-                filename.startswith('./roles/ComputeSriovRT.yaml') or \
-                filename.startswith('./roles/ComputeHCIOvsDpdk.yaml'):
-            exclude = [
-                'OS::TripleO::Services::OVNController',
-                'OS::TripleO::Services::ComputeNeutronOvsAgent',
-                'OS::TripleO::Services::Tuned',
-                'OS::TripleO::Services::NeutronVppAgent',
-                'OS::TripleO::Services::Vpp',
-                'OS::TripleO::Services::NeutronLinuxbridgeAgent']
-            retval |= validate_with_compute_role_services(filename, tpl, exclude)
-
-        if filename.startswith('./roles/ComputeRealTime.yaml'):
-            exclude = [
-                'OS::TripleO::Services::Tuned',
-            ]
-            retval |= validate_with_compute_role_services(filename, tpl, exclude)
-
-        if filename.startswith('./roles/Hci'):
-            retval |= validate_hci_role(filename, tpl)
-
-        if filename.startswith('./roles/Ceph'):
-            retval |= validate_ceph_role(filename, tpl)
-
-        if filename.startswith('./roles/ControllerNoCeph.yaml'):
-            retval |= validate_controller_no_ceph_role(filename, tpl)
-
-        if filename == './roles/Compute.yaml':
-            retval |= validate_multiarch_compute_roles(filename, tpl)
-
-        if filename in ('./roles/ComputeLocalEphemeral.yaml',
-                        './roles/ComputeRBDEphemeral.yaml'):
-            retval |= validate_with_compute_role_services(filename, tpl)
-
-        # NOTE(hjensas): The routed network data example is very different ...
-        # We need to develop a more advanced validator, probably using a schema
-        # definition instead.
-        if (filename.startswith('./network_data_') and
-                not filename.endswith(('routed.yaml',
-                                       'undercloud.yaml'))):
-            result = validate_network_data_file(filename)
-            retval |= result
-        else:
-            result = retval
 
-        if result == 0 and is_heat_template:
-            # check for old style nic config files
-            retval |= validate_nic_config_file(filename, tpl)
+        for rule in VALIDATION_RULES.match(filename):
+            if rule.heat_templates_only and not is_heat_template:
+                continue
+            if rule.if_valid and retval:
+                continue
+            with recorder.rule(rule.name):
+                retval |= rule.validator(filename, tpl)
 
     except Exception:
-        print(traceback.format_exc())
+        with recorder.rule(recorder.failed_rule or 'validate'):
+            add_finding('error', traceback.format_exc().rstrip())
         return 1
     # yaml is OK, now walk the parameters and output a warning for unused ones
     if is_heat_template:
-        for p, data in tpl.get('parameters', {}).items():
-            definition = {'data': data, 'filename': filename}
-            param_map.setdefault(p, []).append(definition)
-            if p in required_params:
-                continue
-            str_p = '\'%s\'' % p
-            in_resources = str_p in str(tpl.get('resources', {}))
-            in_outputs = str_p in str(tpl.get('outputs', {}))
-            in_conditions = str_p in str(tpl.get('conditions', {}))
-            in_parameter_groups = str_p in str(tpl.get('parameter_groups', {}))
-            if (not in_resources and not in_outputs and not in_conditions
-                and not in_parameter_groups and args.quiet < 2):
-                print('Warning: parameter %s in template %s '
-                      'appears to be unused' % (p, filename))
-
-        resources = tpl.get('resources')
-        if resources:
-            for resource, data in resources.items():
-                if data['type'] in DEPLOYMENT_RESOURCE_TYPES:
-                    if 'name' not in data['properties']:
-                        print('ERROR: resource %s from %s missing name property.'
-                                % (resource, filename))
-                        return 1
-
-                elif data['type'] in CONFIG_RESOURCE_TYPES:
-                    if 'outputs' in data['properties']:
-                        if filename in HEAT_OUTPUTS_EXCLUSIONS:
-                            if args.quiet < 1:
-                                print('Resource %s from %s uses Heat '
-                                      'outputs which are not supported with '
-                                      'config-download (ignored due to '
-                                      'exclusions).'
-                                      % (resource, filename))
-                        else:
-                            print('ERROR: resource %s from %s uses Heat '
-                                  'outputs which are not supported with '
-                                  'config-download.'
-                                  % (resource, filename))
+        with recorder.rule('unused_parameters'):
+            references = get_param_references(tpl)
+            for p, data in tpl.get('parameters', {}).items():
+                definition = {'data': data, 'filename': filename}
+                param_map.setdefault(p, []).append(definition)
+                if p in required_params:
+                    continue
+                if p not in references:
+                    add_finding('warning', 'parameter %s in template %s '
+                                'appears to be unused' % (p, filename),
+                                tpl['parameters'], p)
+
+        with recorder.rule('resource_properties'):
+            resources = tpl.get('resources')
+            if resources:
+                for resource, data in resources.items():
+                    if data['type'] in DEPLOYMENT_RESOURCE_TYPES:
+                        if 'name' not in data['properties']:
+                            add_finding('error', 'resource %s from %s '
+                                        'missing name property.'
+                                        % (resource, filename),
+                                        resources, resource)
                             return 1
 
+                    elif data['type'] in CONFIG_RESOURCE_TYPES:
+                        if 'outputs' in data['properties']:
+                            if filename in HEAT_OUTPUTS_EXCLUSIONS:
+                                add_finding(
+                                    'note', 'Resource %s from %s uses Heat '
+                                    'outputs which are not supported with '
+                                    'config-download (ignored due to '
+                                    'exclusions).' % (resource, filename),
+                                    resources, resource)
+                            else:
+                                add_finding('error', 'resource %s from %s '
+                                            'uses Heat outputs which are not '
+                                            'supported with config-download.'
+                                            % (resource, filename),
+                                            resources, resource)
+                                return 1
+
     return retval
 
 
-def validate_upgrade_tasks(upgrade_tasks):
+def validate_upgrade_tasks(upgrade_tasks, filename):
     # some templates define its upgrade_tasks via list_concat
     if isinstance(upgrade_tasks, dict):
         if upgrade_tasks.get('list_concat'):
-            return validate_upgrade_tasks(upgrade_tasks['list_concat'][1])
+            return validate_upgrade_tasks(upgrade_tasks['list_concat'][1],
+                                          filename)
         elif upgrade_tasks.get('get_attr'):
             return 0
 
-    for task in upgrade_tasks:
+    for i, task in enumerate(upgrade_tasks):
         task_name = task.get("name", "")
         whenline = task.get("when", "")
-        if (type(whenline) == list):
+        if isinstance(whenline, list):
             if any('step|int ' in condition for condition in whenline) \
                     and ('step|int == ' not in whenline[0]):
-                print('ERROR: \'step|int ==\' condition should be evaluated '
-                      'first in when conditions for task (%s)' % (task))
+                add_finding('error', '\'step|int ==\' condition should be '
+                            'evaluated first in when conditions for task '
+                            '(%s) in %s'
+                            % (task, location(filename, upgrade_tasks, i)),
+                            upgrade_tasks, i)
                 return 1
         else:
-            if (' and ' in whenline) and (' or ' not in whenline) \
-                    and args.quiet < 2:
-                print("Warning: Consider specifying \'and\' conditions as "
-                      "a list to improve readability in task: \"%s\""
-                      % (task_name))
+            if (' and ' in whenline) and (' or ' not in whenline):
+                add_finding('warning', "Consider specifying \'and\' "
+                            "conditions as a list to improve readability in "
+                            "task: \"%s\" in %s"
+                            % (task_name,
+                               location(filename, upgrade_tasks, i)),
+                            upgrade_tasks, i)
     return 0
 
 
 def validate_network_data_file(data_file_path):
     try:
-        with open(data_file_path, 'r') as data_file:
-            data_file = yaml.load(data_file.read(), Loader=yaml.SafeLoader)
+        data_file = load_yaml(data_file_path)
 
         base_file_path = os.path.dirname(data_file_path) + "/network_data.yaml"
-        with open(base_file_path, 'r') as base_file:
-            base_file = yaml.load(base_file.read(), Loader=yaml.SafeLoader)
+        base_file = load_yaml(base_file_path)
 
         retval = 0
         for n in base_file:
             if n not in data_file:
-                print('ERROR: The following network from network_data.yaml is '
-                      'missing or differs in %s : %s'
-                      % (data_file_path, n))
+                add_finding('error', 'The following network from '
+                            'network_data.yaml is missing or differs in '
+                            '%s : %s' % (data_file_path, n), data_file)
                 retval = 1
         return retval
     except Exception:
-        print(traceback.format_exc())
+        add_finding('error', traceback.format_exc().rstrip())
         return 1
     return 0
 
@@ -1337,16 +1503,357 @@ def validate_nic_config_file(filename, tpl):
                 if (r[1].get('type') == 'OS::Heat::StructuredConfig' and
                     r[1].get('properties', {}).get('group') == 'os-apply-config' and
                     r[1].get('properties', {}).get('config', {}).get('os_net_config')):
-                    print('ERROR: Using old format of nic configuration file: %s' % filename)
-                    print('tools/yaml-nic-config-2-script.py can be used to convert to new format')
+                    add_finding('error', 'Using old format of nic '
+                                'configuration file: %s\n'
+                                'tools/yaml-nic-config-2-script.py can be '
+                                'used to convert to new format' % filename,
+                                tpl['resources'], r[0])
                     return 1
 
     except Exception:
-        print(traceback.format_exc())
+        add_finding('error', traceback.format_exc().rstrip())
         return 1
     return 0
 
 
+def fingerprint(data):
+    """Return a hashable value equal for data equal to each other"""
+    if isinstance(data, dict):
+        return frozenset((fingerprint(k), fingerprint(v))
+                         for k, v in data.items())
+    if isinstance(data, list):
+        return tuple(fingerprint(v) for v in data)
+    if isinstance(data, set):
+        return 'set', frozenset(data)
+    return data
+
+
+def parameter_fingerprint(name, data):
+    """Fingerprint of a parameter definition, without its excluded fields"""
+    exclusions = PARAMETER_DEFINITION_EXCLUSIONS.get(name, [])
+    if exclusions and isinstance(data, dict):
+        # Override excluded fields so they don't affect the result
+        data = dict(data, **dict((field, 'IGNORED')
+                                 for field in exclusions))
+    return fingerprint(data)
+
+
+def find_mismatched_parameters(param_map):
+    """Find the parameters which are not defined the same way everywhere
+
+    Yields the name of these parameters and their definitions, grouped by
+    variant in the order they were found.
+    """
+    for p, defs in param_map.items():
+        # Nothing to validate if the parameter is only defined once
+        if len(defs) == 1:
+            continue
+        variants = collections.OrderedDict()
+        for d in defs:
+            variants.setdefault(parameter_fingerprint(p, d['data']),
+                                []).append(d)
+        if len(variants) > 1:
+            yield p, list(variants.values())
+
+
+ValidationRule = collections.namedtuple(
+    'ValidationRule', ['validator', 'globs', 'exclude', 'overrides',
+                       'heat_templates_only', 'if_valid', 'name'])
+
+
+class ValidationRules(object):
+    """Registry of the validators run on the files matching path globs
+
+    The globs are matched against the path of the files as they were found,
+    e.g. ./deployment/nova/nova-api-container-puppet.yaml, and '*' also
+    matches '/'. The globs without wildcards are looked up in a dict, the
+    others are compiled once and grouped by their literal prefix, so only
+    the globs whose prefix matches a path are tried on it.
+    """
+
+    def __init__(self):
+        self.rules = []
+        self._index = None
+
+    def register(self, validator, globs, exclude=(), overrides=None,
+                 heat_templates_only=False, if_valid=False, name=None):
+        """Run validator(filename, tpl) on the files matching globs
+
+        The validator returns 0 if the file is valid, and 1 otherwise. The
+        validators of a file run in the order they were registered.
+
+        :param exclude: Globs of the files the validator does not run on
+        :param overrides: A dict mapping paths to True, to also run the
+                          validator on these files, or False, to not run it
+                          on them even if they match the globs
+        :param heat_templates_only: Only run the validator on Heat templates
+        :param if_valid: Only run the validator if the previous ones passed
+        :param name: The rule id used in the reports, the name of the
+                     validator function by default
+        """
+        if name is None:
+            name = getattr(validator, 'func', validator).__name__
+        self.rules.append(ValidationRule(validator, tuple(globs),
+                                         tuple(exclude), overrides or {},
+                                         heat_templates_only, if_valid, name))
+        self._index = None
+
+    def _build_index(self):
+        exact = collections.defaultdict(set)
+        prefixes = collections.defaultdict(list)
+        excludes = []
+        for i, rule in enumerate(self.rules):
+            for glob in rule.globs:
+                prefix = re.split(r'[*?[]', glob, 1)[0]
+                if prefix == glob:
+                    exact[glob].add(i)
+                else:
+                    prefixes[prefix].append(
+                        (i, re.compile(fnmatch.translate(glob))))
+            for path, enabled in rule.overrides.items():
+                if enabled:
+                    exact[path].add(i)
+            excludes.append([re.compile(fnmatch.translate(glob))
+                             for glob in rule.exclude])
+        self._index = (exact, list(prefixes.items()), excludes)
+
+    def match(self, filename):
+        """Return the rules to apply to a file, in their registration order"""
+        if self._index is None:
+            self._build_index()
+        exact, prefixes, excludes = self._index
+
+        matches = set(exact.get(filename, ()))
+        for prefix, globs in prefixes:
+            if filename.startswith(prefix):
+                matches.update(i for i, glob in globs if glob.match(filename))
+        return [self.rules[i] for i in sorted(matches)
+                if self.rules[i].overrides.get(filename, True) and
+                not any(glob.match(filename) for glob in excludes[i])]
+
+
+VALIDATION_RULES = ValidationRules()
+
+VALIDATION_RULES.register(
+    validate_service,
+    ['./deployment/*-baremetal-puppet.yaml',
+     './deployment/*-pacemaker-puppet.yaml'],
+    overrides=VALIDATE_PUPPET_OVERRIDE)
+VALIDATION_RULES.register(
+    validate_service_hiera_interpol,
+    ['*puppet/services*', '*docker/services*', './deployment/*'])
+VALIDATION_RULES.register(
+    validate_docker_logging_template,
+    ['./deployment/logging/files/*', './deployment/logging/stdout/*'])
+VALIDATION_RULES.register(
+    validate_docker_service,
+    ['./deployment/*-container-puppet.yaml'],
+    exclude=['./deployment/logging/files/*', './deployment/logging/stdout/*'],
+    overrides=VALIDATE_DOCKER_OVERRIDE)
+VALIDATION_RULES.register(
+    validate_hci_compute_services_default,
+    ['*hyperconverged-ceph.yaml'])
+VALIDATION_RULES.register(
+    lambda filename, tpl: validate_role_name(filename),
+    ['./roles/*'], name='validate_role_name')
+VALIDATION_RULES.register(
+    validate_hci_computehci_role,
+    ['./roles/ComputeHCI.yaml', './roles/ComputeHCIOvsDpdk.yaml',
+     './roles/ComputeHCISriov.yaml'])
+VALIDATION_RULES.register(
+    functools.partial(validate_controller_storage_nfs,
+                      exclude_service=['OS::TripleO::Services::CephNfs']),
+    ['./roles/ControllerStorageNfs.yaml'])
+VALIDATION_RULES.register(
+    validate_controller_dashboard,
+    ['./roles/ControllerStorageDashboard.yaml'])
+VALIDATION_RULES.register(
+    functools.partial(validate_with_compute_role_services, exclude_service=[
+        'OS::TripleO::Services::OVNController',
+        'OS::TripleO::Services::ComputeNeutronOvsAgent',
+        'OS::TripleO::Services::Tuned',
+        'OS::TripleO::Services::NeutronVppAgent',
+        'OS::TripleO::Services::Vpp',
+        'OS::TripleO::Services::NeutronLinuxbridgeAgent']),
+    ['./roles/ComputeOvsDpdk.yaml', './roles/ComputeSriov.yaml',
+     './roles/ComputeOvsDpdkRT.yaml', './roles/ComputeSriovRT.yaml',
+     './roles/ComputeHCIOvsDpdk.yaml'])
+VALIDATION_RULES.register(
+    functools.partial(validate_with_compute_role_services,
+                      exclude_service=['OS::TripleO::Services::Tuned']),
+    ['./roles/ComputeRealTime.yaml'])
+VALIDATION_RULES.register(validate_hci_role, ['./roles/Hci*'])
+VALIDATION_RULES.register(validate_ceph_role, ['./roles/Ceph*'])
+VALIDATION_RULES.register(
+    validate_controller_no_ceph_role,
+    ['./roles/ControllerNoCeph.yaml'])
+VALIDATION_RULES.register(
+    validate_multiarch_compute_roles,
+    ['./roles/Compute.yaml'])
+VALIDATION_RULES.register(
+    validate_with_compute_role_services,
+    ['./roles/ComputeLocalEphemeral.yaml',
+     './roles/ComputeRBDEphemeral.yaml'])
+# NOTE(hjensas): The routed network data example is very different ...
+# We need to develop a more advanced validator, probably using a schema
+# definition instead.
+VALIDATION_RULES.register(
+    lambda filename, tpl: validate_network_data_file(filename),
+    ['./network_data_*'],
+    exclude=['*routed.yaml', '*undercloud.yaml'],
+    name='validate_network_data_file')
+# check for old style nic config files
+VALIDATION_RULES.register(
+    validate_nic_config_file, ['*'],
+    heat_templates_only=True, if_valid=True)
+
+
+class Report(object):
+    """Findings written to a file as the files are validated
+
+    The findings are added with add() as soon as the results of a file are
+    merged, and close() writes the run time of the rules.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def add(self, findings, filename=None, timings=None):
+        """Write the findings of a file and the run time of its rules
+
+        filename is None for the findings of the checks run on the whole
+        tree.
+        """
+
+    def close(self, rule_timings):
+        """Finish the report
+
+        :param rule_timings: A dict mapping the rule ids to the number of
+                             files they ran on and their total run time
+        """
+        self.stream.close()
+
+
+class JsonLinesReport(Report):
+    """One JSON object per finding, followed by one per rule timing"""
+
+    def _write(self, record):
+        self.stream.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def add(self, findings, filename=None, timings=None):
+        for finding in findings:
+            record = {'type': 'finding'}
+            record.update(finding)
+            self._write(record)
+        self.stream.flush()
+
+    def close(self, rule_timings):
+        for rule, (calls, seconds) in rule_timings.items():
+            self._write({'type': 'timing', 'rule': rule, 'calls': calls,
+                         'seconds': round(seconds, 6)})
+        super(JsonLinesReport, self).close(rule_timings)
+
+
+class JUnitReport(Report):
+    """A JUnit XML test suite with a test case per rule run on a file
+
+    The errors are reported as failures and the other findings in the
+    output of the test case.
+    """
+
+    def __init__(self, stream):
+        super(JUnitReport, self).__init__(stream)
+        self.stream.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                          '<testsuite name="yaml-validate">\n')
+
+    def _testcase(self, classname, rule, seconds, findings):
+        self.stream.write('  <testcase classname=%s name=%s time="%.6f"' % (
+            quoteattr(classname), quoteattr(rule), seconds))
+        if not findings:
+            self.stream.write('/>\n')
+            return
+        self.stream.write('>\n')
+        errors = [f['message'] for f in findings if f['severity'] == 'error']
+        others = ['%s: %s' % (f['severity'], f['message'])
+                  for f in findings if f['severity'] != 'error']
+        if errors:
+            self.stream.write('    <failure message=%s>%s</failure>\n' % (
+                quoteattr(errors[0].splitlines()[0]),
+                escape('\n'.join(errors))))
+        if others:
+            self.stream.write('    <system-out>%s</system-out>\n' %
+                              escape('\n'.join(others)))
+        self.stream.write('  </testcase>\n')
+
+    def add(self, findings, filename=None, timings=None):
+        timings = timings or {}
+        by_rule = collections.OrderedDict((rule, []) for rule in timings)
+        for finding in findings:
+            by_rule.setdefault(finding['rule'], []).append(finding)
+        for rule, rule_findings in by_rule.items():
+            self._testcase(filename or 'yaml-validate', rule,
+                           timings.get(rule, 0), rule_findings)
+        self.stream.flush()
+
+    def close(self, rule_timings):
+        self.stream.write('</testsuite>\n')
+        super(JUnitReport, self).close(rule_timings)
+
+
+class SarifReport(Report):
+    """A SARIF 2.1.0 log, the results are written before the tool section
+
+    The run time of the rules is in the properties of the rules of the tool.
+    """
+
+    LEVELS = {'error': 'error', 'warning': 'warning', 'note': 'note'}
+
+    def __init__(self, stream):
+        super(SarifReport, self).__init__(stream)
+        self.separator = ''
+        self.stream.write(
+            '{"$schema": "https://json.schemastore.org/sarif-2.1.0.json", '
+            '"version": "2.1.0", "runs": [{"results": [')
+
+    def add(self, findings, filename=None, timings=None):
+        for finding in findings:
+            result = {'ruleId': finding['rule'],
+                      'level': self.LEVELS[finding['severity']],
+                      'message': {'text': finding['message']}}
+            if finding['file']:
+                result_location = {'physicalLocation': {'artifactLocation': {
+                    'uri': os.path.normpath(finding['file'])}}}
+                if finding['line']:
+                    result_location['physicalLocation']['region'] = {
+                        'startLine': finding['line']}
+                if finding['path']:
+                    result_location['logicalLocations'] = [{
+                        'fullyQualifiedName': '.'.join(
+                            str(key) for key in finding['path'])}]
+                result['locations'] = [result_location]
+            self.stream.write(self.separator +
+                              json.dumps(result, sort_keys=True))
+            self.separator = ', '
+        self.stream.flush()
+
+    def close(self, rule_timings):
+        rules = [{'id': rule,
+                  'properties': {'calls': calls,
+                                 'seconds': round(seconds, 6)}}
+                 for rule, (calls, seconds) in rule_timings.items()]
+        self.stream.write('], "tool": %s}]}\n' % json.dumps(
+            {'driver': {'name': 'yaml-validate', 'rules': rules}},
+            sort_keys=True))
+        super(SarifReport, self).close(rule_timings)
+
+
+REPORT_FORMATS = collections.OrderedDict([
+    ('jsonl', JsonLinesReport),
+    ('junit', JUnitReport),
+    ('sarif', SarifReport),
+])
+
+
 def parse_args():
     p = argparse.ArgumentParser()
 
@@ -1354,110 +1861,756 @@ def parse_args():
                    action='count',
                    default=0,
                    help='output warnings and errors (-q) or only errors (-qq)')
+    p.add_argument('--jobs', '-j',
+                   type=int,
+                   default=1,
+                   help='number of processes used to validate the files, 0 '
+                        'uses one per CPU')
+    p.add_argument('--cache-dir',
+                   help='directory where the validation results are kept '
+                        'between the runs, they are not kept when it is not '
+                        'given. The results are loaded with pickle, only '
+                        'use a directory written by this script')
+    p.add_argument('--render-j2',
+                   action='store_true',
+                   help='render the j2 templates of the directories in '
+                        'memory and validate the rendered documents, '
+                        'without writing them to the tree')
+    p.add_argument('--roles-data',
+                   default='roles_data.yaml',
+                   help='roles data used by --render-j2, relative to the '
+                        'directories (default: %(default)s)')
+    p.add_argument('--network-data',
+                   default='network_data.yaml',
+                   help='network data used by --render-j2, relative to the '
+                        'directories (default: %(default)s)')
+    p.add_argument('--watch',
+                   action='store_true',
+                   help='keep running and validate the files affected by '
+                        'the changes in the paths, rendering the changed j2 '
+                        'templates again with --render-j2')
+    p.add_argument('--changed-since',
+                   metavar='REF',
+                   help='only report the files changed since the git '
+                        'REF and the files whose validation depends on '
+                        'them. The other files are validated for the checks '
+                        'of the whole tree when their results are not in '
+                        'the cache, so all the files are validated when it '
+                        'is empty')
+    p.add_argument('--report',
+                   metavar='FILE',
+                   help='write the findings and the run time of each rule '
+                        'to FILE while the files are validated')
+    p.add_argument('--report-format',
+                   choices=list(REPORT_FORMATS),
+                   default='jsonl',
+                   help='format of the --report file (default: %(default)s)')
     p.add_argument('path_args',
                    nargs='*',
                    default=['.'])
 
-    return p.parse_args()
+    args = p.parse_args()
+    if args.changed_since and not args.cache_dir:
+        p.error('--changed-since needs --cache-dir')
+    return args
 
 
-args = parse_args()
-path_args = args.path_args
-quiet = args.quiet
-exit_val = 0
-failed_files = []
-base_endpoint_map = None
-env_endpoint_maps = list()
-param_map = {}
+def validate_file(file_path):
+    """Validate a file with a parameter map of its own
 
-for base_path in path_args:
+    Returns the validation result, the parameters defined in the file, and
+    the findings and run time of the rules.
+    """
+    file_param_map = {}
+    recorder = RuleRecorder(file_path)
+    failed = validate(file_path, file_param_map, recorder)
+    return (failed, file_param_map, recorder.findings,
+            dict(recorder.timings))
+
+
+def validate_file_tracked(item):
+    """Run validate_file, tracking the files loaded by the validators
+
+    Returns the files loaded or looked up by the validators and the result
+    of validate_file.
+    """
+    _loaded_files.clear()
+    result = validate_file(item[0])
+    return sorted(_loaded_files), result
+
+
+class ValidationCache(object):
+    """Validation results of the files, kept between the runs
+
+    The results are stored by the content hash of the validated file and
+    of the validator and the modules it uses, and are only used again when
+    the other files loaded or looked up by the validators, like the roles
+    compared with roles/Compute.yaml or the templates included by a
+    service, have not changed or appeared either. They hold the findings
+    of all the severities, whatever the --quiet level.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        version = hashlib.sha1()
+        for path in VALIDATOR_SOURCES:
+            with open(path, 'rb') as f:
+                version.update(f.read())
+        self.version = version.hexdigest()
+        self.hashes = {}
+
+    def file_hash(self, path):
+        path = os.path.abspath(path)
+        if path in _rendered_files:
+            return hashlib.sha1(
+                _rendered_files[path].encode('utf-8')).hexdigest()
+        if path not in self.hashes:
+            try:
+                with open(path, 'rb') as f:
+                    self.hashes[path] = hashlib.sha1(f.read()).hexdigest()
+            except (IOError, OSError):
+                self.hashes[path] = None
+        return self.hashes[path]
+
+    def _entry_path(self, item):
+        file_path, validated = item
+        key = hashlib.sha1(repr((self.version, file_path, validated,
+                                 self.file_hash(file_path))).encode('utf-8'))
+        key = key.hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, item):
+        """Return the files loaded by the validators and the result
+
+        Returns None when there is no result for the current content of the
+        file and of the files loaded by the validators.
+        """
+        try:
+            with open(self._entry_path(item), 'rb') as f:
+                dependencies, result = pickle.load(f)
+        except Exception:
+            return None
+        for path, file_hash in dependencies.items():
+            if self.file_hash(path) != file_hash:
+                return None
+        return sorted(dependencies), result
+
+    def set(self, item, loaded_files, result):
+        entry_path = self._entry_path(item)
+        dependencies = dict((path, self.file_hash(path))
+                            for path in loaded_files)
+        try:
+            if not os.path.isdir(os.path.dirname(entry_path)):
+                os.makedirs(os.path.dirname(entry_path))
+            with tempfile.NamedTemporaryFile(
+                    'wb', dir=os.path.dirname(entry_path),
+                    delete=False) as f:
+                pickle.dump((dependencies, result), f,
+                            pickle.HIGHEST_PROTOCOL)
+            os.rename(f.name, entry_path)
+        except (IOError, OSError) as e:
+            print('Warning: could not update the validation cache: %s' % e)
+
+
+class DependencyIndex(object):
+    """Files loaded by the validators of each file, kept with the cache
+
+    This is used to find the files to validate again when some files
+    changed, e.g. all the roles compared with roles/Compute.yaml when it
+    changed.
+    """
+
+    def __init__(self, cache_dir):
+        """The index is only kept in memory when cache_dir is None"""
+        self.path = None
+        self.dependencies = {}
+        if cache_dir is not None:
+            self.path = os.path.join(cache_dir, 'dependencies.json')
+            try:
+                with open(self.path) as f:
+                    self.dependencies = json.load(f)
+            except (IOError, OSError, ValueError):
+                pass
+        self.updated = False
+
+    def update(self, file_path, loaded_files):
+        path = os.path.abspath(file_path)
+        loaded_files = sorted(loaded_files)
+        if self.dependencies.get(path) != loaded_files:
+            self.dependencies[path] = loaded_files
+            self.updated = True
+
+    def is_affected(self, file_path, changed):
+        """Whether the validation of a file depends on the changed files
+
+        The files which are not indexed yet are always affected.
+        """
+        path = os.path.abspath(file_path)
+        if path in changed or path not in self.dependencies:
+            return True
+        return not changed.isdisjoint(self.dependencies[path])
+
+    def save(self):
+        if self.path is None or not self.updated:
+            return
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            with tempfile.NamedTemporaryFile(
+                    'w', dir=os.path.dirname(self.path), delete=False) as f:
+                json.dump(self.dependencies, f, sort_keys=True)
+            os.rename(f.name, self.path)
+            self.updated = False
+        except (IOError, OSError) as e:
+            print('Warning: could not update the dependency index: %s' % e)
+
+
+def changed_files(ref):
+    """Return the absolute paths of the files changed since a git ref
+
+    This includes the changes which are not committed yet and the untracked
+    files.
+    """
+    try:
+        output = subprocess.check_output(
+            ['git', 'diff', '--name-only', '--relative', ref, '--'])
+        output += subprocess.check_output(
+            ['git', 'ls-files', '--others', '--exclude-standard'])
+    except (OSError, subprocess.CalledProcessError) as e:
+        print('ERROR: could not list the files changed since %s: %s'
+              % (ref, e))
+        sys.exit(1)
+    return set(os.path.abspath(path)
+               for path in output.decode('utf-8').splitlines() if path)
+
+
+def select_changed(files, changed, index):
+    """Return the paths of the files affected by the changed files
+
+    These are the changed files and the files whose validators loaded them.
+    """
+    if not changed.isdisjoint(VALIDATOR_SOURCES):
+        return set(file_path for file_path, _ in files)
+    selected = set()
+    for file_path, validated in files:
+        if not validated:
+            if os.path.abspath(file_path) in changed:
+                selected.add(file_path)
+        elif index.is_affected(file_path, changed):
+            selected.add(file_path)
+    return selected
+
+
+def init_worker(worker_args, rendered_files):
+    global args
+    args = worker_args
+    _rendered_files.update(rendered_files)
+
+
+class J2Renderer(object):
+    """The j2 templates of a tree, rendered in memory
+
+    The rendered documents are validated like the files of the tree, and
+    are used instead of the files left in the tree by process-templates.py.
+    The roles and network data are kept between the renders, which only
+    render again the changed templates, and the render module keeps the
+    compiled templates.
+    """
+
+    def __init__(self, base_path):
+        self.base_path = base_path
+        self.root = os.path.abspath(base_path)
+        self.data_paths = (
+            os.path.abspath(os.path.join(base_path, args.roles_data)),
+            os.path.abspath(os.path.join(base_path, args.network_data)))
+        self.roles_data = self.network_data = None
+        self.outputs = set()
+
+    def _render_all(self, changed):
+        """Whether the changed files may change the output of all templates
+
+        These are the roles and network data, j2_excludes.yaml, the
+        templates included by the others and the removed templates.
+        """
+        for path in changed:
+            if path in self.data_paths or path.endswith('.j2') or \
+                    os.path.basename(path) == 'j2_excludes.yaml' or \
+                    (path.endswith('.j2.yaml') and not os.path.exists(path)):
+                return True
+        return False
+
+    def render(self, changed=None):
+        """Render the templates affected by the changed files, all by default
+
+        Returns the paths of the rendered files which were added, removed,
+        or whose content changed.
+        """
+        plan = None
+        if changed is not None:
+            changed = set(path for path in changed
+                          if path.startswith(self.root + os.sep))
+            templates = set(os.path.relpath(path, self.root)
+                            for path in changed if path.endswith('.j2.yaml'))
+            if not self._render_all(changed):
+                if not templates:
+                    return set()
+                plan = [t for t in render.plan_templates(self.base_path)
+                        if t.template_path in templates]
+        if plan is None:
+            self.roles_data = render.load_roles_data(self.data_paths[0])
+            self.network_data = render.load_network_data(self.data_paths[1])
+
+        outputs = {}
+        for unit in render.render_units(
+                self.base_path, self.roles_data, self.network_data,
+                render.load_j2_excludes(self.base_path), plan=plan):
+            if not unit.excluded:
+                path = os.path.abspath(os.path.join(self.base_path,
+                                                    unit.output_path))
+                outputs[path] = render.render_unit(unit)
+
+        updated = set(path for path, content in outputs.items()
+                      if _rendered_files.get(path) != content)
+        _rendered_files.update(outputs)
+        if plan is None:
+            updated |= self.outputs - set(outputs)
+            for path in self.outputs - set(outputs):
+                del _rendered_files[path]
+            self.outputs = set(outputs)
+        return updated
+
+
+# The directories not watched by --watch
+WATCH_IGNORED_DIRS = ('.git', '.tox')
+
+
+class PollingWatcher(object):
+    """Find the changed files by comparing their modification times"""
+
+    name = 'polling'
+
+    def __init__(self, paths, interval=0.5):
+        self.paths = paths
+        self.interval = interval
+        self.mtimes = self._scan()
+
+    def _scan(self):
+        mtimes = {}
+        for base_path in self.paths:
+            for subdir, dirs, files in os.walk(base_path):
+                dirs[:] = [d for d in dirs if d not in WATCH_IGNORED_DIRS]
+                for f in files:
+                    path = os.path.abspath(os.path.join(subdir, f))
+                    try:
+                        mtimes[path] = os.stat(path).st_mtime
+                    except OSError:
+                        pass
+            if os.path.isfile(base_path):
+                mtimes[os.path.abspath(base_path)] = \
+                    os.stat(base_path).st_mtime
+        return mtimes
+
+    def wait(self):
+        """Wait for files to change and return their absolute paths"""
+        while True:
+            time.sleep(self.interval)
+            mtimes = self._scan()
+            changed = set(path for path in set(mtimes) | set(self.mtimes)
+                          if mtimes.get(path) != self.mtimes.get(path))
+            self.mtimes = mtimes
+            if changed:
+                return changed
+
+
+class InotifyWatcher(object):
+    """Find the changed files with inotify, through the C library
+
+    Every directory of the trees is watched, the ones created later too.
+    """
+
+    name = 'inotify'
+
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_ISDIR = 0x40000000
+    MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+            IN_DELETE)
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, paths, delay=0.1):
+        """Raise OSError or AttributeError when inotify is not available
+
+        :param delay: Time to wait for more events once a file changed, as
+                      editors save files in several steps
+        """
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.delay = delay
+        self.dirs = {}
+        for base_path in paths:
+            if os.path.isdir(base_path):
+                self._add_tree(base_path)
+            else:
+                self._add_watch(os.path.dirname(base_path) or '.')
+
+    def _add_watch(self, path):
+        path = os.path.abspath(path)
+        wd = self.libc.inotify_add_watch(self.fd, path.encode('utf-8'),
+                                         self.MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(),
+                          'inotify_add_watch failed on %s' % path)
+        self.dirs[wd] = path
+
+    def _add_tree(self, path):
+        """Watch a directory tree, and return the files it contains"""
+        found = set()
+        for subdir, dirs, files in os.walk(path):
+            dirs[:] = [d for d in dirs if d not in WATCH_IGNORED_DIRS]
+            self._add_watch(subdir)
+            found.update(os.path.abspath(os.path.join(subdir, f))
+                         for f in files)
+        return found
+
+    def _read(self):
+        changed = set()
+        data = os.read(self.fd, 65536)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0').decode('utf-8')
+            offset += length
+            if wd not in self.dirs or not name:
+                continue
+            path = os.path.join(self.dirs[wd], name)
+            if not mask & self.IN_ISDIR:
+                changed.add(path)
+            elif mask & (self.IN_CREATE | self.IN_MOVED_TO) and \
+                    name not in WATCH_IGNORED_DIRS:
+                changed |= self._add_tree(path)
+        return changed
+
+    def wait(self):
+        """Wait for files to change and return their absolute paths"""
+        changed = set()
+        while not changed:
+            changed = self._read()
+        while select.select([self.fd], [], [], self.delay)[0]:
+            changed |= self._read()
+        return changed
+
+
+def get_watcher(paths):
+    """Watch paths with inotify if available, by polling otherwise"""
+    try:
+        return InotifyWatcher(paths)
+    except (AttributeError, OSError):
+        return PollingWatcher(paths)
+
+
+def collect_files(base_path):
+    """List the files to validate under a path given on the command line
+
+    Yields (file_path, validated) pairs, with validated False for the files
+    which are only checked for their location. The
+    files rendered in memory are listed after the files of the tree.
+    """
     if os.path.isdir(base_path):
+        found = set()
+        cache_dir = args.cache_dir and os.path.abspath(args.cache_dir)
         for subdir, dirs, files in os.walk(base_path):
-            if '.tox' in dirs:
-                dirs.remove('.tox')
+            dirs[:] = [d for d in dirs if d != '.tox' and
+                       os.path.abspath(os.path.join(subdir, d)) != cache_dir]
             for f in files:
                 file_path = os.path.join(subdir, f)
-                if 'environments/services-docker' in file_path:
-                    print("ERROR: environments/services-docker should not be "
-                          "used any more, use environments/services instead: "
-                          "%s " % file_path)
-                    failed_files.append(file_path)
-                    exit_val |= 1
-
                 if f.endswith('.yaml') and not f.endswith('.j2.yaml'):
-                    failed = validate(file_path, param_map)
-                    if failed:
-                        failed_files.append(file_path)
-                    exit_val |= failed
-                    if f == ENDPOINT_MAP_FILE:
-                        base_endpoint_map = get_base_endpoint_map(file_path)
-                    if f in envs_containing_endpoint_map:
-                        env_endpoint_map = get_endpoint_map_from_env(file_path)
-                        if env_endpoint_map:
-                            env_endpoint_maps.append(env_endpoint_map)
+                    found.add(os.path.abspath(file_path))
+                    yield file_path, True
+                else:
+                    yield file_path, False
+        root = os.path.abspath(base_path)
+        for path in sorted(_rendered_files):
+            if path not in found and path.startswith(root + os.sep):
+                yield os.path.join(base_path,
+                                   os.path.relpath(path, root)), True
     elif os.path.isfile(base_path) and base_path.endswith('.yaml'):
-        failed = validate(base_path, param_map)
-        if failed:
-            failed_files.append(base_path)
-        exit_val |= failed
+        yield base_path, True
     else:
         print('Unexpected argument %s' % base_path)
         exit_usage()
 
-if base_endpoint_map and \
-        len(env_endpoint_maps) == len(envs_containing_endpoint_map):
-    for env_endpoint_map in env_endpoint_maps:
-        matches = validate_endpoint_map(base_endpoint_map,
-                                        env_endpoint_map['map'])
-        if not matches:
-            print("ERROR: %s needs to be updated to match changes in base "
-                  "endpoint map" % env_endpoint_map['file'])
-            failed_files.append(env_endpoint_map['file'])
+
+class TreeValidation(object):
+    """Results of the files of the trees and checks of the whole trees
+
+    The results of the files are kept, so that --watch only validates the
+    files affected by a change before running the checks of the whole trees
+    again.
+    """
+
+    def __init__(self, cache=None, index=None, report=None):
+        self.cache = cache
+        self.index = index
+        self.report = report
+        self.results = collections.OrderedDict()
+        self.rule_timings = collections.OrderedDict()
+
+    def add_findings(self, filename, findings, timings, cached=False):
+        # The run time of the rules is only counted when they ran
+        if not cached:
+            for rule, seconds in timings.items():
+                calls, total = self.rule_timings.get(rule, (0, 0))
+                self.rule_timings[rule] = (calls + 1, total + seconds)
+        findings = shown_findings(findings)
+        print_findings(findings)
+        if self.report is not None:
+            self.report.add(findings, filename, timings)
+
+    def validate(self, files, pool=None, selected=None):
+        """Validate files and report the findings of the selected ones
+
+        :param files: (file_path, validated) pairs, as listed by
+                      collect_files()
+        :param pool: The multiprocessing pool validating the files, they
+                     are validated in this process if it is None
+        :param selected: The paths of the files whose findings are
+                         reported, all of them by default. The results of
+                         the others are only used by check_tree(), and
+                         they are only validated when their result is not
+                         cached.
+        Returns the exit value and the files which failed the validation.
+        """
+        exit_val = 0
+        failed_files = []
+        items = [item for item in files if item[1]]
+        cached_results = {}
+        if self.cache is not None:
+            for item in items:
+                result = self.cache.get(item)
+                if result is not None:
+                    cached_results[item] = result
+        items = [item for item in items if item not in cached_results]
+        if pool is not None:
+            # The workers validate the files in the background, their
+            # results are merged below in the same order as a serial run
+            results = pool.imap(validate_file_tracked, items)
+        else:
+            results = six.moves.map(validate_file_tracked, items)
+
+        for file_path, validated in files:
+            is_selected = selected is None or file_path in selected
+            if 'environments/services-docker' in file_path and is_selected:
+                recorder = RuleRecorder(file_path)
+                with recorder.rule('services_docker'):
+                    add_finding('error', "environments/services-docker "
+                                "should not be used any more, use "
+                                "environments/services instead: %s "
+                                % file_path)
+                self.add_findings(recorder.filename, recorder.findings,
+                                  recorder.timings)
+                failed_files.append(file_path)
+                exit_val |= 1
+            if not validated:
+                continue
+
+            item = (file_path, validated)
+            if item in cached_results:
+                loaded_files, result = cached_results[item]
+            else:
+                loaded_files, result = next(results)
+                if self.cache is not None:
+                    self.cache.set(item, loaded_files, result)
+            self.index.update(file_path, loaded_files)
+            self.results[item] = result
+            if is_selected:
+                failed, _, findings, timings = result
+                if args.quiet < 1:
+                    print('Validating %s' % file_path)
+                self.add_findings(file_path, findings, timings,
+                                  cached=item in cached_results)
+                if failed:
+                    failed_files.append(file_path)
+                exit_val |= failed
+        return exit_val, failed_files
+
+    def forget(self, files):
+        """Drop the results of the files which are not in the trees anymore"""
+        items = set(files)
+        for item in list(self.results):
+            if item not in items:
+                del self.results[item]
+
+    def check_tree(self):
+        """Run the checks of the whole trees on the results of the files
+
+        Returns the exit value and the files which failed the checks.
+        """
+        exit_val = 0
+        failed_files = []
+        param_map = {}
+        for result in self.results.values():
+            for p, defs in result[1].items():
+                param_map.setdefault(p, []).extend(defs)
+
+        # Validate that duplicate parameters defined in multiple files all
+        # have the same definition.
+        mismatch_count = 0
+        recorder = RuleRecorder(None)
+        for p, variants in find_mismatched_parameters(param_map):
+            mismatch_count += 1
             exit_val |= 1
-        elif args.quiet < 1:
-            print("%s matches base endpoint map" % env_endpoint_map['file'])
-else:
-    print("ERROR: Did not find expected number of environments containing the "
-          "EndpointMap parameter.  If you meant to add or remove one of these "
-          "environments then you also need to update this tool.")
-    if not base_endpoint_map:
-        failed_files.append(ENDPOINT_MAP_FILE)
-    if len(env_endpoint_maps) != len(envs_containing_endpoint_map):
-        matched_files = set(os.path.basename(matched_env_file['file'])
-                            for matched_env_file in env_endpoint_maps)
-        failed_files.extend(set(envs_containing_endpoint_map) - matched_files)
-    exit_val |= 1
-
-# Validate that duplicate parameters defined in multiple files all have the
-# same definition.
-mismatch_count = 0
-for p, defs in param_map.items():
-    # Nothing to validate if the parameter is only defined once
-    if len(defs) == 1:
-        continue
-    check_data = [d['data'] for d in defs]
-    # Override excluded fields so they don't affect the result
-    exclusions = PARAMETER_DEFINITION_EXCLUSIONS.get(p, [])
-    ex_dict = {}
-    for field in exclusions:
-        ex_dict[field] = 'IGNORED'
-    for d in check_data:
-        d.update(ex_dict)
-    # If all items in the list are not == the first, then the check fails
-    if check_data.count(check_data[0]) != len(check_data):
-        mismatch_count += 1
-        exit_val |= 1
-        failed_files.extend([d['filename'] for d in defs])
-        print('Mismatched parameter definitions found for "%s"' % p)
-        print('Definitions found:')
-        for d in defs:
-            print('  %s:\n    %s' % (d['filename'], d['data']))
-print('Mismatched parameter definitions: %d' % mismatch_count)
-
-if failed_files:
-    print('Validation failed on:')
-    for f in failed_files:
-        print(f)
-else:
-    print('Validation successful!')
-sys.exit(exit_val)
+            with recorder.rule('parameter_definitions'):
+                lines = ['Mismatched parameter definitions found for "%s"'
+                         % p, 'Definitions found:']
+                for defs in variants:
+                    lines.append('  %s in %d file(s):' % (defs[0]['data'],
+                                                          len(defs)))
+                    for d in defs:
+                        lines.append('    %s' % d['filename'])
+                        failed_files.append(d['filename'])
+                add_finding('error', '\n'.join(lines))
+        self.add_findings(recorder.filename, recorder.findings,
+                          recorder.timings)
+        print('Mismatched parameter definitions: %d' % mismatch_count)
+        return exit_val, failed_files
+
+
+def print_summary(failed_files):
+    if failed_files:
+        print('Validation failed on:')
+        for f in failed_files:
+            print(f)
+    else:
+        print('Validation successful!')
+
+
+def watch(validation, renderers):
+    """Validate the files again when they change, until interrupted
+
+    Only the outputs of the changed j2 templates are rendered again, and
+    only the files affected by the changes are validated before the checks
+    of the whole trees run again on the results kept in memory.
+    """
+    watcher = get_watcher(args.path_args)
+    print('Watching %s for changes (%s), press Ctrl-C to stop'
+          % (', '.join(args.path_args), watcher.name))
+    try:
+        while True:
+            changed = set(path for path in watcher.wait()
+                          if path.endswith(('.yaml', '.j2')))
+            if not changed:
+                continue
+            start = time.time()
+            try:
+                for renderer in renderers:
+                    changed |= renderer.render(changed)
+            except render.TemplateRenderError as e:
+                print('ERROR: %s' % e)
+                continue
+            for path in changed:
+                _yaml_cache.pop(path, None)
+            if validation.cache is not None:
+                validation.cache.hashes.clear()
+
+            exit_val = 0
+            failed_files = []
+            all_files = []
+            validated = 0
+            for base_path in args.path_args:
+                files = list(collect_files(base_path))
+                all_files.extend(files)
+                selected = select_changed(files, changed, validation.index)
+                validated += len(selected)
+                file_exit_val, file_failed = validation.validate(
+                    [f for f in files if f[0] in selected])
+                exit_val |= file_exit_val
+                failed_files.extend(file_failed)
+            validation.forget(all_files)
+            validation.index.save()
+            tree_exit_val, tree_failed = validation.check_tree()
+            print_summary(failed_files + tree_failed)
+            print('%d file(s) validated in %.2fs' % (validated,
+                                                     time.time() - start))
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+    global args
+    args = parse_args()
+    path_args = args.path_args
+    jobs = args.jobs or multiprocessing.cpu_count()
+
+    report = None
+    if args.report:
+        report = REPORT_FORMATS[args.report_format](open(args.report, 'w'))
+    cache = None
+    if args.cache_dir:
+        cache = ValidationCache(args.cache_dir)
+    index = DependencyIndex(args.cache_dir)
+    validation = TreeValidation(cache, index, report)
+    changed = None
+    if args.changed_since:
+        changed = changed_files(args.changed_since)
+
+    renderers = []
+    if args.render_j2:
+        renderers = [J2Renderer(base_path) for base_path in path_args
+                     if os.path.isdir(base_path)]
+        try:
+            for renderer in renderers:
+                renderer.render()
+        except render.TemplateRenderError as e:
+            print('ERROR: %s' % e)
+            sys.exit(1)
+
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, init_worker,
+                                    (args, _rendered_files))
+
+    exit_val = 0
+    failed_files = []
+    try:
+        for base_path in path_args:
+            files = list(collect_files(base_path))
+            selected = None
+            if changed is not None:
+                # The results of the other files are only used by the
+                # checks of the whole tree
+                selected = select_changed(files, changed, index)
+                if args.quiet < 1:
+                    print('%d file(s) of %s affected by the changes since %s'
+                          % (len(selected), base_path, args.changed_since))
+            file_exit_val, file_failed = validation.validate(files, pool,
+                                                             selected)
+            exit_val |= file_exit_val
+            failed_files.extend(file_failed)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    index.save()
+
+    tree_exit_val, tree_failed = validation.check_tree()
+    exit_val |= tree_exit_val
+    failed_files.extend(tree_failed)
+    if report is not None:
+        report.close(validation.rule_timings)
+        # --watch does not report the findings of the next runs
+        validation.report = None
+
+    print_summary(failed_files)
+    if args.watch:
+        watch(validation, renderers)
+    sys.exit(exit_val)
+
+
+if __name__ == '__main__':
+    main()
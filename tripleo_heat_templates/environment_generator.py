@@ -18,7 +18,12 @@ from collections import defaultdict
 import errno
 import os
 import sys
-import yaml
+
+try:
+    from tripleo_heat_templates import yaml_utils
+except ImportError:
+    # Run as a script from a tree where the package is not installed
+    import yaml_utils
 
 
 _PARAM_FORMAT = u"""%(indent_space)s  # %(description)s
@@ -84,7 +89,7 @@ def _generate_environment(input_env, output_path, parent_env=None):
     static_names = env.get('static', [])
     for template_file, template_data in env.get('files', {}).items():
         with open(template_file) as f:
-            f_data = yaml.safe_load(f)
+            f_data = yaml_utils.safe_load(f)
             f_params = f_data['parameters']
             f_parameter_defaults.update(f_params)
         for t_param_role, t_params in template_data.items():
@@ -214,7 +219,7 @@ def generate_environments(config_path, output_path):
     for config_file in config_files:
         print('Reading environment definitions from %s' % config_file)
         with open(config_file) as f:
-            config = yaml.safe_load(f)
+            config = yaml_utils.safe_load(f)
         for env in config['environments']:
             _generate_environment(env, output_path)
 
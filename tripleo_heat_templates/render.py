@@ -0,0 +1,407 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Render the j2 templates of a tripleo-heat-templates tree in memory.
+
+There are three kinds of j2 templates:
+
+1. *.role.j2.yaml - rendered once per role, with the role data
+2. *.network.j2.yaml - rendered once per enabled network, with the
+   network data, for the networks and the network ports
+3. *.j2.yaml - rendered once, with all the roles and networks data
+
+render_templates() returns the rendered content of the whole tree, keyed by
+the path of the output file relative to the root of the tree, while
+render_units() only lists what has to be rendered, so that callers can
+render the units themselves, for example in a pool of processes.
+"""
+
+import collections
+import errno
+import hashlib
+import os
+import time
+
+import jinja2
+import six
+
+from tripleo_heat_templates import yaml_utils
+
+
+__all__ = ['Template', 'RenderUnit', 'TemplateRenderError',
+           'load_roles_data', 'load_network_data', 'load_j2_excludes',
+           'plan_templates', 'render_units', 'render_unit',
+           'render_unit_timed', 'estimated_cost', 'render_templates']
+
+TEMPLATE_KINDS = (ROLE_TEMPLATE, NETWORK_TEMPLATE, NORMAL_TEMPLATE) = (
+    'role', 'network', 'normal')
+
+Template = collections.namedtuple('Template', [
+    # Path of the j2 template, relative to the root of the tree
+    'template_path',
+    # One of TEMPLATE_KINDS
+    'kind',
+    # Content of the j2 template
+    'j2_template',
+    # Directories searched for the templates included by the template
+    'search_path',
+    # Whether the template is a NIC config template, named after the roles
+    'nic_config',
+    # Whether the role template uses the {{role}} form instead of
+    # {{role.name}}, in which case it is rendered with the role name only
+    'legacy_role',
+    # Whether the network template is a network port template
+    'ports',
+])
+
+RenderUnit = collections.namedtuple('RenderUnit', [
+    # Path of the j2 template, relative to the root of the tree
+    'template_path',
+    # Content of the j2 template
+    'j2_template',
+    # Variables used to render the template
+    'j2_data',
+    # Path of the rendered file, relative to the root of the tree
+    'output_path',
+    # Directories searched for the templates included by the template
+    'search_path',
+    # Whether the output is listed in j2_excludes.yaml
+    'excluded',
+])
+
+# Per process caches of the jinja2 environments, one per template search
+# path, and of the compiled templates, keyed by the hash of their source.
+_bytecode_cache = None
+_environments = {}
+_template_code = {}
+_templates = {}
+
+
+class TemplateRenderError(Exception):
+    pass
+
+
+def source_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def init_cache(cache_dir=None):
+    """Set up the jinja2 bytecode cache of the current process.
+
+    Compiled templates are stored in cache_dir so that later runs can skip
+    compiling them again. The cache is disabled when cache_dir is None.
+    """
+    global _bytecode_cache
+    _environments.clear()
+    _template_code.clear()
+    _templates.clear()
+    _bytecode_cache = None
+    if cache_dir:
+        try:
+            os.makedirs(cache_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        _bytecode_cache = jinja2.FileSystemBytecodeCache(cache_dir)
+
+
+def get_environment(search_path):
+    """Get the shared jinja2 environment for a template search path."""
+    env = _environments.get(search_path)
+    if env is None:
+        j2_loader = jinja2.loaders.FileSystemLoader(list(search_path))
+        env = jinja2.Environment(loader=j2_loader,
+                                 bytecode_cache=_bytecode_cache)
+        _environments[search_path] = env
+    return env
+
+
+def _compile(env, j2_template, j2_hash):
+    """Compile a j2 template string, using the bytecode cache if enabled."""
+    bcc = env.bytecode_cache
+    if bcc is None:
+        return env.compile(j2_template)
+    bucket = bcc.get_bucket(env, j2_hash, None, j2_template)
+    if bucket.code is None:
+        bucket.code = env.compile(j2_template)
+        bcc.set_bucket(bucket)
+    return bucket.code
+
+
+def get_template(search_path, j2_template):
+    """Get a template object for a j2 template string.
+
+    Every template source is compiled only once per process, the compiled
+    code is shared by the environments of all the search paths.
+    """
+    j2_hash = source_hash(j2_template)
+    template = _templates.get((search_path, j2_hash))
+    if template is None:
+        env = get_environment(search_path)
+        code = _template_code.get(j2_hash)
+        if code is None:
+            code = _compile(env, j2_template, j2_hash)
+            _template_code[j2_hash] = code
+        template = env.template_class.from_code(env, code,
+                                                env.make_globals(None))
+        _templates[(search_path, j2_hash)] = template
+    return template
+
+
+def render_unit(unit):
+    """Render a RenderUnit and return the result.
+
+    This is a module level function so that it can be used by the worker
+    processes of a multiprocessing pool.
+    """
+    try:
+        template = get_template(unit.search_path, unit.j2_template)
+        return template.render(**unit.j2_data)
+    except jinja2.exceptions.TemplateError as ex:
+        raise TemplateRenderError("Error rendering template %s : %s"
+                                  % (unit.output_path, six.text_type(ex)))
+
+
+def render_unit_timed(unit):
+    """Render a RenderUnit and return the result and the time it took."""
+    start = time.time()
+    rendered = render_unit(unit)
+    return rendered, time.time() - start
+
+
+def load_roles_data(path):
+    with open(path) as roles_data_file:
+        return yaml_utils.safe_load(roles_data_file)
+
+
+def load_network_data(path):
+    with open(path) as network_data_file:
+        return yaml_utils.safe_load(network_data_file) or []
+
+
+def load_j2_excludes(template_path):
+    """Get the output paths listed in the j2_excludes.yaml of a tree."""
+    j2_excludes_path = os.path.join(template_path, 'j2_excludes.yaml')
+    if not os.path.exists(j2_excludes_path):
+        return []
+    with open(j2_excludes_path) as j2_excludes_file:
+        j2_excludes = yaml_utils.safe_load(j2_excludes_file) or {}
+    return j2_excludes.get('name') or []
+
+
+def _noop(*args):
+    pass
+
+
+def _enabled_networks(network_data, log):
+    n_map = collections.OrderedDict()
+    for n in network_data:
+        if (n.get('enabled') is not False):
+            n_map[n.get('name')] = n
+            if not n.get('name_lower'):
+                n_map[n.get('name')]['name_lower'] = n.get('name').lower()
+        else:
+            log("skipping %s network: network is disabled" % n.get('name'))
+    return n_map
+
+
+def plan_templates(template_path, search_root=None):
+    """Find and classify all the j2 templates of a tree.
+
+    Every template is read and classified once, so that the templates can
+    then be expanded into render units for each role or network without
+    inspecting them again.
+
+    :param template_path: The root directory of the templates tree
+    :param search_root: Directory searched for the templates included by the
+                        templates, after the directory of the template
+                        itself. Defaults to template_path.
+    :returns: A list of Template tuples, in the order the tree is walked.
+    """
+    if search_root is None:
+        search_root = template_path
+    plan = []
+    for subdir, dirs, files in os.walk(template_path):
+        # NOTE(flaper87): Ignore hidden dirs as we don't
+        # generate templates for those.
+        # Note the slice assignment for `dirs` is necessary
+        # because we need to modify the *elements* in the
+        # dirs list rather than the reference to the list.
+        # This way we'll make sure os.walk will iterate over
+        # the shrunk list. os.walk doesn't have an API for
+        # filtering dirs at this point.
+        dirs[:] = [d for d in dirs if not d[0] == '.']
+        files = [f for f in files if not f[0] == '.']
+
+        rel_dir = os.path.relpath(subdir, template_path)
+        if rel_dir == '.':
+            rel_dir = ''
+
+        for f in files:
+            if f.endswith('.role.j2.yaml'):
+                kind = ROLE_TEMPLATE
+            elif f.endswith('.network.j2.yaml'):
+                kind = NETWORK_TEMPLATE
+            elif f.endswith('.j2.yaml'):
+                kind = NORMAL_TEMPLATE
+            else:
+                continue
+            file_path = os.path.join(rel_dir, f)
+            with open(os.path.join(subdir, f)) as j2_template:
+                template_data = j2_template.read()
+            plan.append(Template(
+                template_path=file_path,
+                kind=kind,
+                j2_template=template_data,
+                search_path=(subdir, search_root),
+                nic_config='network/config' in file_path,
+                # Backwards compatibility with templates
+                # that specify {{role}} vs {{role.name}}
+                legacy_role=(kind == ROLE_TEMPLATE and
+                             '{{role.name}}' not in template_data),
+                ports=subdir.endswith('ports')))
+    return plan
+
+
+def render_units(template_path, roles_data, network_data, j2_excludes=None,
+                 search_root=None, log=None, plan=None):
+    """Generate the units needed to render all the j2 templates of a tree.
+
+    We do three templating passes here:
+
+    1. *.role.j2.yaml - we template just the role name
+       and create multiple files (one per role)
+    2  *.network.j2.yaml - we template the network name and
+       data and create multiple files for networks and
+       network ports (one per network)
+    3. *.j2.yaml - we template with all roles_data,
+       and create one file common to all roles
+
+    :param template_path: The root directory of the templates tree
+    :param roles_data: The roles data, as loaded from roles_data.yaml
+    :param network_data: The networks data, as loaded from network_data.yaml
+    :param j2_excludes: Output paths, relative to template_path, of role and
+                        network templates which should not be rendered.
+                        The units of those outputs are generated with
+                        excluded set.
+    :param search_root: Directory searched for the templates included by the
+                        templates, after the directory of the template
+                        itself. Defaults to template_path.
+    :param log: Function called with progress messages
+    :param plan: The templates to render, as returned by plan_templates().
+                 The templates of template_path are planned by default.
+    """
+    log = log or _noop
+    j2_excludes = set(os.path.normpath(e) for e in j2_excludes or [])
+    if plan is None:
+        plan = plan_templates(template_path, search_root)
+
+    role_names = [r.get('name') for r in roles_data]
+    r_map = {}
+    for r in roles_data:
+        r_map[r.get('name')] = r
+
+    n_map = _enabled_networks(network_data, log)
+
+    def make_unit(template, j2_data, out_f, excludable=True):
+        out_f_path = os.path.join(os.path.dirname(template.template_path),
+                                  out_f)
+        return RenderUnit(template.template_path, template.j2_template,
+                          j2_data, out_f_path, template.search_path,
+                          excludable and
+                          os.path.normpath(out_f_path) in j2_excludes)
+
+    for template in plan:
+        f = os.path.basename(template.template_path)
+        if template.kind == ROLE_TEMPLATE:
+            log("jinja2 rendering role template %s" % f)
+            log("jinja2 rendering roles %s" % ",".join(role_names))
+            for role in role_names:
+                if (template.nic_config and
+                        r_map[role].get('deprecated_nic_config_name')):
+                    out_f = r_map[role].get('deprecated_nic_config_name')
+                elif template.nic_config:
+                    out_f = "%s.yaml" % role.lower()
+                else:
+                    out_f = "-".join([role.lower(),
+                                      f.replace('.role.j2.yaml', '.yaml')])
+                if template.legacy_role:
+                    j2_data = {'role': role,
+                               'networks': network_data}
+                else:
+                    j2_data = {'role': r_map[role],
+                               'networks': network_data}
+                yield make_unit(template, j2_data, out_f)
+
+        elif template.kind == NETWORK_TEMPLATE:
+            log("jinja2 rendering network template %s" % f)
+            log("jinja2 rendering networks %s" % ",".join(n_map))
+            for network in n_map:
+                j2_data = {'network': n_map[network]}
+                # Output file names in "<name>.yaml" format
+                out_f = f.replace('.network.j2.yaml', '.yaml')
+                if template.ports:
+                    out_f = out_f.replace('port',
+                                          n_map[network]['name_lower'])
+                else:
+                    out_f = out_f.replace('network',
+                                          n_map[network]['name_lower'])
+                yield make_unit(template, j2_data, out_f)
+
+        else:
+            log("jinja2 rendering normal template %s" % f)
+            j2_data = {'roles': roles_data,
+                       'networks': network_data}
+            out_f = f.replace('.j2.yaml', '.yaml')
+            # NOTE: j2_excludes only applies to the role and network
+            # expansions, the normal templates are always rendered
+            yield make_unit(template, j2_data, out_f, excludable=False)
+
+
+def estimated_cost(unit):
+    """Roughly estimate the cost of rendering a unit.
+
+    The cost is the size of the template source, multiplied by the number of
+    roles for the templates which loop over all the roles.
+    """
+    cost = len(unit.j2_template)
+    roles = unit.j2_data.get('roles')
+    if roles and ' in roles' in unit.j2_template:
+        cost *= len(roles)
+    return cost
+
+
+def render_templates(template_path, roles_data, network_data,
+                     j2_excludes=None, lazy=False):
+    """Render all the j2 templates of a tree in memory.
+
+    :param template_path: The root directory of the templates tree
+    :param roles_data: The roles data, as loaded from roles_data.yaml
+    :param network_data: The networks data, as loaded from network_data.yaml
+    :param j2_excludes: Output paths, relative to template_path, of role and
+                        network templates which should not be rendered.
+                        Defaults to the ones listed in the j2_excludes.yaml
+                        file of the tree.
+    :param lazy: Return a generator of (output path, content) tuples which
+                 renders the templates as it is consumed, instead of a dict.
+    :returns: An OrderedDict mapping the path of every rendered file,
+              relative to template_path, to its content.
+    """
+    if j2_excludes is None:
+        j2_excludes = load_j2_excludes(template_path)
+    rendered = ((unit.output_path, render_unit(unit))
+                for unit in render_units(template_path, roles_data,
+                                         network_data, j2_excludes)
+                if not unit.excluded)
+    if lazy:
+        return rendered
+    return collections.OrderedDict(rendered)
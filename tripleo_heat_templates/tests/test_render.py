@@ -0,0 +1,171 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import types
+
+import fixtures
+from oslotest import base
+
+from tripleo_heat_templates import render
+
+roles_data = [
+    {'name': 'Controller'},
+    {'name': 'Compute', 'deprecated_nic_config_name': 'compute-old.yaml'},
+]
+
+network_data = [
+    {'name': 'InternalApi', 'name_lower': 'internal_api'},
+    {'name': 'Storage'},
+    {'name': 'Tenant', 'enabled': False},
+]
+
+templates = {
+    'overcloud.j2.yaml': (
+        'roles: {% for role in roles %}{{role.name}} {% endfor %}\n'
+        '{% include "common.j2" %}'),
+    'common.j2': 'networks: {{networks|length}}\n',
+    'puppet/role.role.j2.yaml': 'name: {{role.name}}\n',
+    'puppet/legacy.role.j2.yaml': 'name: {{role}}\n',
+    'network/network.network.j2.yaml': 'network: {{network.name_lower}}\n',
+    'network/ports/port.network.j2.yaml': 'port: {{network.name}}\n',
+    'network/config/bond/role.role.j2.yaml': 'nic: {{role.name}}\n',
+    'static.yaml': 'static: true\n',
+}
+
+
+class RenderTestCase(base.BaseTestCase):
+
+    def setUp(self):
+        super(RenderTestCase, self).setUp()
+        self.tht_dir = self.useFixture(fixtures.TempDir()).path
+        for path, content in templates.items():
+            path = os.path.join(self.tht_dir, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(content)
+        render.init_cache()
+
+    def test_render_templates(self):
+        rendered = render.render_templates(self.tht_dir, roles_data,
+                                           network_data)
+        self.assertEqual({
+            'overcloud.yaml': 'roles: Controller Compute \nnetworks: 3',
+            'puppet/controller-role.yaml': 'name: Controller',
+            'puppet/compute-role.yaml': 'name: Compute',
+            'puppet/controller-legacy.yaml': 'name: Controller',
+            'puppet/compute-legacy.yaml': 'name: Compute',
+            'network/internal_api.yaml': 'network: internal_api',
+            'network/storage.yaml': 'network: storage',
+            'network/ports/internal_api.yaml': 'port: InternalApi',
+            'network/ports/storage.yaml': 'port: Storage',
+            'network/config/bond/controller.yaml': 'nic: Controller',
+            'network/config/bond/compute-old.yaml': 'nic: Compute',
+        }, dict(rendered))
+
+    def test_render_templates_excludes(self):
+        rendered = render.render_templates(
+            self.tht_dir, roles_data, network_data,
+            j2_excludes=['puppet/compute-role.yaml', 'network/storage.yaml'])
+        self.assertNotIn('puppet/compute-role.yaml', rendered)
+        self.assertNotIn('network/storage.yaml', rendered)
+        self.assertIn('puppet/controller-role.yaml', rendered)
+
+    def test_render_templates_excludes_normal_template(self):
+        rendered = render.render_templates(
+            self.tht_dir, roles_data, network_data,
+            j2_excludes=['overcloud.yaml'])
+        self.assertIn('overcloud.yaml', rendered)
+
+    def test_render_templates_excludes_file(self):
+        with open(os.path.join(self.tht_dir, 'j2_excludes.yaml'), 'w') as f:
+            f.write('name:\n  - puppet/compute-role.yaml\n')
+        rendered = render.render_templates(self.tht_dir, roles_data,
+                                           network_data)
+        self.assertNotIn('puppet/compute-role.yaml', rendered)
+
+    def test_render_templates_lazy(self):
+        rendered = render.render_templates(self.tht_dir, roles_data,
+                                           network_data, lazy=True)
+        self.assertIsInstance(rendered, types.GeneratorType)
+        self.assertEqual(
+            render.render_templates(self.tht_dir, roles_data, network_data),
+            dict(rendered))
+
+    def test_render_units(self):
+        units = list(render.render_units(self.tht_dir, roles_data,
+                                         network_data))
+        unit = [u for u in units
+                if u.output_path == 'puppet/compute-role.yaml'][0]
+        self.assertEqual('puppet/role.role.j2.yaml', unit.template_path)
+        self.assertEqual({'role': roles_data[1], 'networks': network_data},
+                         unit.j2_data)
+        self.assertEqual((os.path.join(self.tht_dir, 'puppet'),
+                          self.tht_dir), unit.search_path)
+        self.assertFalse(unit.excluded)
+
+    def test_plan_templates(self):
+        plan = dict((t.template_path, t)
+                    for t in render.plan_templates(self.tht_dir))
+        self.assertEqual(6, len(plan))
+        self.assertNotIn('common.j2', plan)
+        self.assertEqual(render.NORMAL_TEMPLATE,
+                         plan['overcloud.j2.yaml'].kind)
+        role = plan['puppet/role.role.j2.yaml']
+        self.assertEqual(render.ROLE_TEMPLATE, role.kind)
+        self.assertFalse(role.legacy_role)
+        self.assertFalse(role.nic_config)
+        self.assertTrue(plan['puppet/legacy.role.j2.yaml'].legacy_role)
+        self.assertTrue(
+            plan['network/config/bond/role.role.j2.yaml'].nic_config)
+        port = plan['network/ports/port.network.j2.yaml']
+        self.assertEqual(render.NETWORK_TEMPLATE, port.kind)
+        self.assertTrue(port.ports)
+        self.assertFalse(plan['network/network.network.j2.yaml'].ports)
+
+    def test_estimated_cost(self):
+        units = dict((u.output_path, u)
+                     for u in render.render_units(self.tht_dir, roles_data,
+                                                  network_data))
+        self.assertEqual(len(templates['overcloud.j2.yaml']) * 2,
+                         render.estimated_cost(units['overcloud.yaml']))
+        self.assertEqual(
+            len(templates['puppet/role.role.j2.yaml']),
+            render.estimated_cost(units['puppet/compute-role.yaml']))
+
+    def test_render_error(self):
+        with open(os.path.join(self.tht_dir, 'broken.j2.yaml'), 'w') as f:
+            f.write('broken: {{ foo( }}\n')
+        self.assertRaises(render.TemplateRenderError,
+                          render.render_templates, self.tht_dir, roles_data,
+                          network_data)
+
+    def test_bytecode_cache(self):
+        cache_dir = self.useFixture(fixtures.TempDir()).path
+        render.init_cache(cache_dir)
+        self.addCleanup(render.init_cache)
+        expected = render.render_templates(self.tht_dir, roles_data,
+                                           network_data)
+        self.assertNotEqual([], os.listdir(cache_dir))
+        render.init_cache(cache_dir)
+        self.assertEqual(expected,
+                         render.render_templates(self.tht_dir, roles_data,
+                                                 network_data))
+
+    def test_render_unit_timed(self):
+        unit = [u for u in render.render_units(self.tht_dir, roles_data,
+                                               network_data)
+                if u.output_path == 'puppet/compute-role.yaml'][0]
+        rendered, seconds = render.render_unit_timed(unit)
+        self.assertEqual('name: Compute', rendered)
+        self.assertGreaterEqual(seconds, 0)
@@ -0,0 +1,91 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+
+import six
+import yaml
+
+from oslotest import base
+
+from tripleo_heat_templates import yaml_utils
+
+template = """heat_template_version: rocky
+parameters:
+  ServiceNetMap:
+    default: {}
+    type: json
+  Zeta: &anchor
+    type: string
+  Alpha:
+    <<: *anchor
+    default: 2019-01-01
+outputs:
+  hostname_map:
+    value:
+      HOSTNAME: {get_attr:[Controller, name]}
+"""
+
+
+class YamlUtilsTestCase(base.BaseTestCase):
+
+    def test_safe_load(self):
+        self.assertEqual(yaml.safe_load(template),
+                         yaml_utils.safe_load(template))
+
+    def test_safe_load_file(self):
+        self.assertEqual(yaml.safe_load(template),
+                         yaml_utils.safe_load(six.StringIO(template)))
+
+    def test_safe_load_error(self):
+        self.assertRaises(yaml.YAMLError, yaml_utils.safe_load,
+                          'foo: [bar\n')
+
+    def test_ordered_load(self):
+        tpl = yaml_utils.ordered_load(six.StringIO(template))
+        self.assertIsInstance(tpl, collections.OrderedDict)
+        self.assertEqual(['heat_template_version', 'parameters', 'outputs'],
+                         list(tpl))
+        self.assertEqual(['ServiceNetMap', 'Zeta', 'Alpha'],
+                         list(tpl['parameters']))
+        self.assertEqual(yaml.safe_load(template), tpl)
+
+    def test_safe_dump(self):
+        tpl = yaml.safe_load(template)
+        self.assertEqual(tpl, yaml.safe_load(yaml_utils.safe_dump(tpl)))
+
+    def test_marked_load(self):
+        tpl = yaml_utils.marked_load(template)
+        self.assertEqual(yaml.safe_load(template), tpl)
+        self.assertIsInstance(tpl, yaml_utils.MarkedDict)
+        self.assertEqual(1, yaml_utils.line_of(tpl))
+        self.assertEqual(2, yaml_utils.line_of(tpl, 'parameters'))
+        self.assertEqual(6, yaml_utils.line_of(tpl['parameters'], 'Zeta'))
+        # The keys merged from the anchor have no line of their own
+        alpha = tpl['parameters']['Alpha']
+        self.assertIsNone(yaml_utils.line_of(alpha, 'type'))
+        self.assertEqual(10, yaml_utils.line_of(alpha, 'default'))
+        self.assertEqual([], alpha.duplicate_keys)
+        self.assertIsNone(yaml_utils.line_of('scalar'))
+
+    def test_marked_load_duplicate_keys(self):
+        tasks = yaml_utils.marked_load(
+            '- name: first\n'
+            '  when: step|int == 1\n'
+            '  when: step|int == 2\n'
+            '- name: second\n')
+        self.assertIsInstance(tasks, yaml_utils.MarkedList)
+        self.assertEqual([1, 4], tasks.item_lines)
+        self.assertEqual(4, yaml_utils.line_of(tasks, 1))
+        self.assertEqual('step|int == 2', tasks[0]['when'])
+        self.assertEqual([('when', 3)], tasks[0].duplicate_keys)
+        self.assertEqual([], tasks[1].duplicate_keys)
@@ -0,0 +1,88 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import shutil
+import subprocess
+import sys
+
+import fixtures
+from oslotest import base
+
+yaml_validate = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__)))), 'tools', 'yaml-validate.py')
+
+template = '''heat_template_version: rocky
+parameters:
+  FooParam:
+    type: string
+    description: %s
+resources: {}
+'''
+
+
+class ChangedSinceTestCase(base.BaseTestCase):
+
+    def setUp(self):
+        super(ChangedSinceTestCase, self).setUp()
+        self.tht_dir = self.useFixture(fixtures.TempDir()).path
+        self.cache_dir = os.path.join(self.tht_dir, '.cache')
+        self.write('a.yaml', 'Foo')
+        self.write('b.yaml', 'Foo')
+        self.git('init', '-q')
+        self.git('add', 'a.yaml', 'b.yaml')
+        self.git('-c', 'user.name=test', '-c', 'user.email=test@example.com',
+                 'commit', '-q', '-m', 'Add the templates')
+
+    def write(self, filename, description):
+        with open(os.path.join(self.tht_dir, filename), 'w') as f:
+            f.write(template % description)
+
+    def git(self, *args):
+        subprocess.check_call(('git',) + args, cwd=self.tht_dir)
+
+    def validate(self, *args):
+        process = subprocess.Popen(
+            (sys.executable, yaml_validate, '--cache-dir', self.cache_dir) +
+            args + ('.',), cwd=self.tht_dir, stdout=subprocess.PIPE,
+            universal_newlines=True)
+        output = process.communicate()[0]
+        return process.returncode, output
+
+    def test_changed_since_cold_cache(self):
+        self.write('a.yaml', 'Bar')
+        returncode, output = self.validate('--changed-since', 'HEAD')
+        self.assertEqual(1, returncode)
+        self.assertIn('Mismatched parameter definitions found for '
+                      '"FooParam"', output)
+
+    def test_changed_since_other_quiet_level(self):
+        self.assertEqual(0, self.validate()[0])
+        self.write('a.yaml', 'Bar')
+        returncode, output = self.validate('-q', '--changed-since', 'HEAD')
+        self.assertEqual(1, returncode)
+        self.assertIn('Mismatched parameter definitions found for '
+                      '"FooParam"', output)
+
+    def test_changed_since_uncached_results(self):
+        self.assertEqual(0, self.validate()[0])
+        # Keep the dependency index, like when the validator changed
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+        self.write('a.yaml', 'Bar')
+        returncode, output = self.validate('--changed-since', 'HEAD')
+        self.assertEqual(1, returncode)
+        self.assertIn('Validating ./a.yaml', output)
+        self.assertNotIn('Validating ./b.yaml', output)
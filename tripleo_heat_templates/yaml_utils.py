@@ -0,0 +1,203 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""YAML loading helpers shared by the template tools.
+
+PyYAML's pure Python scanner dominates the run time of the tools walking the
+whole tree. When PyYAML was built with libyaml, SafeLoader and SafeDumper are
+the CSafeLoader and CSafeDumper classes, which construct the same documents
+several times faster, otherwise they are the pure Python yaml.SafeLoader and
+yaml.SafeDumper.
+
+libyaml is stricter than the pure Python scanner, it rejects for example the
+flow mappings written without a space after the colon which are used in
+some templates, like {get_attr:[Controller, name]}. safe_load() and
+ordered_load() parse again with the pure Python loader the documents libyaml
+rejects, so that they accept the same documents and raise the same errors as
+yaml.safe_load().
+
+marked_load() loads the mappings and sequences into MarkedDict and MarkedList,
+which keep the line numbers of the document, so that the tools can report
+where a problem is, and the keys defined more than once in a mapping, which
+yaml.safe_load() silently overrides.
+
+libyaml's emitter does not always format scalars like the pure Python one,
+e.g. long folded strings and empty mapping keys, so tools writing files that
+are kept in the tree should only use SafeDumper once they have checked that
+their output is unchanged.
+"""
+
+import collections
+
+import yaml
+
+
+__all__ = ['SafeLoader', 'SafeDumper', 'OrderedLoader', 'MarkedLoader',
+           'MarkedDict', 'MarkedList', 'safe_load', 'safe_dump',
+           'ordered_load', 'marked_load', 'line_of', 'libyaml_available']
+
+libyaml_available = getattr(yaml, '__with_libyaml__', False)
+
+if libyaml_available:
+    SafeLoader = yaml.CSafeLoader
+    SafeDumper = yaml.CSafeDumper
+else:
+    SafeLoader = yaml.SafeLoader
+    SafeDumper = yaml.SafeDumper
+
+
+class _OrderedMappings(object):
+    """Load the mappings into OrderedDict to keep their order"""
+
+    def construct_mapping(self, node):
+        self.flatten_mapping(node)
+        return collections.OrderedDict(self.construct_pairs(node))
+
+
+class OrderedLoader(_OrderedMappings, SafeLoader):
+    pass
+
+
+class _PyOrderedLoader(_OrderedMappings, yaml.SafeLoader):
+    pass
+
+
+for _loader in (OrderedLoader, _PyOrderedLoader):
+    _loader.add_constructor(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,
+                            _loader.construct_mapping)
+
+
+class MarkedDict(dict):
+    """A mapping loaded by marked_load()
+
+    line is the line of the mapping and key_lines maps its keys to their
+    lines, counted from 1, or to None for the keys merged from another
+    mapping with <<. duplicate_keys lists the (key, line) pairs of the keys
+    defined again in the mapping, their last value is kept as with
+    yaml.safe_load().
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(MarkedDict, self).__init__(*args, **kwargs)
+        self.line = None
+        self.key_lines = {}
+        self.duplicate_keys = []
+
+
+class MarkedList(list):
+    """A sequence loaded by marked_load()
+
+    line is the line of the sequence and item_lines the lines of its items,
+    counted from 1.
+    """
+
+    def __init__(self, *args):
+        super(MarkedList, self).__init__(*args)
+        self.line = None
+        self.item_lines = []
+
+
+class _Marks(object):
+    """Load the mappings and sequences into MarkedDict and MarkedList"""
+
+    def construct_marked_mapping(self, node):
+        data = MarkedDict()
+        data.line = node.start_mark.line + 1
+        yield data
+        merge_tag = 'tag:yaml.org,2002:merge'
+        own_keys = len([key for key, _ in node.value if key.tag != merge_tag])
+        self.flatten_mapping(node)
+        # The merged keys come first and may be overridden
+        merged_keys = len(node.value) - own_keys
+        for i, (key_node, value_node) in enumerate(node.value):
+            key = self.construct_object(key_node)
+            try:
+                hash(key)
+            except TypeError as exc:
+                raise yaml.constructor.ConstructorError(
+                    'while constructing a mapping', node.start_mark,
+                    'found unacceptable key (%s)' % exc,
+                    key_node.start_mark)
+            line = key_node.start_mark.line + 1
+            if i >= merged_keys and key in data and \
+                    data.key_lines[key] is not None:
+                data.duplicate_keys.append((key, line))
+            data[key] = self.construct_object(value_node)
+            data.key_lines[key] = line if i >= merged_keys else None
+
+    def construct_marked_sequence(self, node):
+        data = MarkedList()
+        data.line = node.start_mark.line + 1
+        yield data
+        data.extend(self.construct_sequence(node))
+        data.item_lines = [item.start_mark.line + 1 for item in node.value]
+
+
+class MarkedLoader(_Marks, SafeLoader):
+    pass
+
+
+class _PyMarkedLoader(_Marks, yaml.SafeLoader):
+    pass
+
+
+for _loader in (MarkedLoader, _PyMarkedLoader):
+    _loader.add_constructor('tag:yaml.org,2002:map',
+                            _loader.construct_marked_mapping)
+    _loader.add_constructor('tag:yaml.org,2002:seq',
+                            _loader.construct_marked_sequence)
+
+
+def _load(stream, loader, py_loader):
+    if loader is py_loader:
+        return yaml.load(stream, Loader=loader)
+    if hasattr(stream, 'read'):
+        stream = stream.read()
+    try:
+        return yaml.load(stream, Loader=loader)
+    except yaml.YAMLError:
+        return yaml.load(stream, Loader=py_loader)
+
+
+def safe_load(stream):
+    """Parse the first YAML document of a stream, like yaml.safe_load()"""
+    return _load(stream, SafeLoader, yaml.SafeLoader)
+
+
+def ordered_load(stream):
+    """Parse the first YAML document of a stream with OrderedLoader"""
+    return _load(stream, OrderedLoader, _PyOrderedLoader)
+
+
+def marked_load(stream):
+    """Parse the first YAML document of a stream with MarkedLoader"""
+    return _load(stream, MarkedLoader, _PyMarkedLoader)
+
+
+def line_of(data, key=None):
+    """Get the line of a mapping or sequence loaded by marked_load()
+
+    With key, get the line of a key of the mapping, or of an item of the
+    sequence. Returns None when the line is not known.
+    """
+    if key is None:
+        return getattr(data, 'line', None)
+    if isinstance(data, MarkedDict):
+        return data.key_lines.get(key)
+    if isinstance(data, MarkedList) and -len(data) <= key < len(data):
+        return data.item_lines[key]
+    return None
+
+
+def safe_dump(data, stream=None, **kwargs):
+    """Serialize an object to YAML, like yaml.safe_dump()"""
+    return yaml.dump(data, stream, Dumper=SafeDumper, **kwargs)